@@ -9,4 +9,33 @@ if (_this_path not in sys.path):
     sys.path.append(_this_path)
 
 import osp as osplib
-from osp import OpenSimPit
\ No newline at end of file
+from osp import OpenSimPit
+from osp_serial import OSPConnection
+from osp_decode import PACKET_AXIS, PACKET_BUTTON, PACKET_RADIO
+
+# Imported on first use: asyncio, selectors and shared_memory are slow to
+# import, and most programs need none of them. Discovery, configuration
+# and curves are only used at startup, by some programs
+def __getattr__(name):
+    if name in ('discover', 'find_port', 'ROLE_MAIN', 'ROLE_RADIO'):
+        import osp_discovery
+        return getattr(osp_discovery, name)
+    if name in ('BoardConfig', 'AxisConfig', 'ButtonConfig'):
+        import osp_config
+        return getattr(osp_config, name)
+    if name == 'AxisCurve':
+        from osp_curve import AxisCurve
+        return AxisCurve
+    if name == 'AsyncOpenSimPit':
+        from osp_async import AsyncOpenSimPit
+        return AsyncOpenSimPit
+    if name == 'SharedStateReader':
+        from osp_shm import SharedStateReader
+        return SharedStateReader
+    if name in ('EventServer', 'EventClient'):
+        import osp_net
+        return getattr(osp_net, name)
+    if name == 'OSPHub':
+        from osp_hub import OSPHub
+        return OSPHub
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
@@ -31,7 +31,13 @@
 
 
 import time
+from threading import Lock
 import osp_serial as osps
+from osp_decode import PACKET_AXIS, PACKET_BUTTON, PACKET_RADIO, PACKET_MESSAGE, curve_value
+from osp_lcd import LCD16x2Buffer, lcd16x2_command, lcd16x2_backlight_command
+from osp_servo import ServoStage, servo_command, DEFAULT_SERVO_MAX_RATE
+from osp_dispatch import DispatchTable
+from osp_queue import OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_COALESCE, DEFAULT_QUEUE_SIZE
 
 
 class OpenSimPit:
@@ -40,68 +46,347 @@ class OpenSimPit:
     For documentation, check the repository at
     https://github.com/fbcosentino/opensimpit
     """
-    
-    axes_callbacks = []
-    buttons_callbacks = []
-    press_callbacks = []
-    release_callbacks = []
-    radio_callbacks = []
 
-    def __init__(self, serial_port):
-        osps.open_port(serial_port)
-        time.sleep(2.5) # Some arduinos have flow control reset routine when opening the port
+    def __init__(self, serial_port, queue_size=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST, coalesce_axes=False, hub=None, servo_max_rate=DEFAULT_SERVO_MAX_RATE, reset_on_open=True, ready_timeout=osps.DEFAULT_READY_TIMEOUT, auto_reconnect=True, shared_state=None, coalesce_backlog=None, flow_control=True):
+        # queue_size limits how many received packets are kept while check()
+        # is not being called. overflow_policy is one of OVERFLOW_DROP_OLDEST,
+        # OVERFLOW_DROP_NEWEST or OVERFLOW_COALESCE
+        # If coalesce_axes is True, each check() calls the axis callbacks at
+        # most once per axis, with the latest value only
+        # hub is an optional OSPHub, to read several boards from a single thread
+        # servo_max_rate is the default limit of commands per second per servo
+        # If reset_on_open is False, DTR/RTS are held low so Uno/Nano/Mega
+        # boards don't restart when the port is opened
+        # ready_timeout is how long to wait for the board to be ready (INIT
+        # or an answer to AT) before returning
+        # With auto_reconnect, a lost port is opened again in the background,
+        # and check() sends the whole output state once the board is back
+        # shared_state is the name of a shared memory block where the input
+        # state is published for other processes (see osp_shm), or None
+        # If coalesce_backlog is set, axes are coalesced like with
+        # coalesce_axes while at least that many packets wait to be checked
+        # With flow_control, the board answers pace the commands sent (see
+        # osp_writer). Disable it for boards which don't answer commands
+        
+        # Callbacks belong to each instance, so several boards
+        # can be used in the same process
+        self.axes_callbacks = []
+        self.buttons_callbacks = []
+        self.press_callbacks = []
+        self.release_callbacks = []
+        self.radio_callbacks = []
+        # Response curve table of each axis (see set_axis_curve), by axis number
+        self.axis_curves = {}
+        # Callbacks bound to specific input numbers (see on_axis() etc)
+        self.axis_dispatch = DispatchTable()
+        self.button_state_dispatch = DispatchTable()
+        self.press_dispatch = DispatchTable()
+        self.release_dispatch = DispatchTable()
+        self.radio_dispatch = DispatchTable()
+        
+        # Shadow buffers of the 16x2 LCDs, by LCD number
+        self.lcd16x2_buffers = {}
+        # Last backlight state of each LCD, by LCD number
+        self.lcd16x2_backlights = {}
+        # Last battery display arguments, None if never set
+        self.battery_display = None
+        
+        # Servo positions, sent latest-wins and rate limited per servo.
+        # Held back targets are sent from the writer thread when due
+        self.servos = ServoStage(servo_max_rate)
+        self._servo_lock = Lock()
+        
+        # Objects receiving the input state (see add_event_sink)
+        self.event_sinks = []
+        # Input state published to other processes, updated by check()
+        self.shared_state = None
+        if shared_state is not None:
+            from osp_shm import SharedStateWriter
+            self.shared_state = SharedStateWriter(shared_state)
+            self.add_event_sink(self.shared_state)
+        
+        # Set when the board restarted, so the outputs are sent again
+        self._replay_pending = False
+        
+        self.connection = osps.OSPConnection(queue_size, overflow_policy, coalesce_axes, hub, flow_control=flow_control, auto_reconnect=auto_reconnect, coalesce_backlog=coalesce_backlog)
+        self.connection.open(serial_port, reset_on_open)
+        # Some arduinos restart when the port is opened, returns as soon as
+        # the board is ready instead of waiting the worst case
+        self.is_ready = self.connection.wait_ready(ready_timeout)
 
     def __del__(self):
-        osps.close_port()
+        connection = getattr(self, 'connection', None)
+        if connection is not None:
+            connection.close()
+        shared_state = getattr(self, 'shared_state', None)
+        if shared_state is not None:
+            shared_state.close()
 
     # ========================================================================
     # PC -> BOARD
 
     def lcd16x2_clear(self, lcd_num):
-        osps.send_command("!LCC="+str(int(lcd_num)))
+        self.connection.send_command("!LCC="+str(int(lcd_num)))
+        self._get_lcd16x2_buffer(lcd_num).clear()
         
 
     def lcd16x2_set_backlight(self, lcd_num, active):
-        osps.send_command("!LCB="+str(int(lcd_num))+","+('1' if active else '0'))
+        self.lcd16x2_backlights[int(lcd_num)] = bool(active)
+        self.connection.send_command(lcd16x2_backlight_command(lcd_num, active))
 
     def lcd16x2_message(self, lcd_num, row, col, message):
-        osps.send_command("!LC="+str(int(lcd_num))+","+str(int(row))+","+str(int(col))+","+message)
+        """Writes the message and sends only the characters not already on the display"""
+        self.lcd16x2_write(lcd_num, row, col, message)
+        self.lcd16x2_flush(lcd_num)
+
+    def lcd16x2_write(self, lcd_num, row, col, message):
+        """Writes the message in the LCD shadow buffer only. Use lcd16x2_flush() to send"""
+        self._get_lcd16x2_buffer(lcd_num).write(row, col, message)
+
+    def lcd16x2_flush(self, lcd_num=None):
+        """Sends the changes written to one LCD (or to all, if lcd_num is None)"""
+        if lcd_num is None:
+            buffers = list(self.lcd16x2_buffers.values())
+        else:
+            buffers = [self._get_lcd16x2_buffer(lcd_num)]
+        for buffer in buffers:
+            for row, col, text in buffer.flush():
+                future = self.connection.send_command(lcd16x2_command(buffer.lcd_num, row, col, text))
+                self._watch_lcd16x2_run(future, buffer, row, col, text)
+
+    def _watch_lcd16x2_run(self, future, buffer, row, col, text):
+        # Called back from the reader or writer thread once answered
+        def done(future):
+            if osps.command_failed(future):
+                buffer.unsent(row, col, text)
+        future.add_done_callback(done)
+
+    def _get_lcd16x2_buffer(self, lcd_num):
+        lcd_num = int(lcd_num)
+        buffer = self.lcd16x2_buffers.get(lcd_num)
+        if buffer is None:
+            buffer = LCD16x2Buffer(lcd_num)
+            self.lcd16x2_buffers[lcd_num] = buffer
+        return buffer
 
 
     def servo_set_position(self, servo_num, percentage):
-        osps.send_command("!S="+str(int(servo_num))+","+str(int(percentage)))
+        """Sets the servo target. It is sent right away unless the servo is
+        rate limited, in which case the latest target is sent once allowed"""
+        with self._servo_lock:
+            self.servos.set(servo_num, percentage)
+        self._flush_servos()
+
+    def servo_set_max_rate(self, servo_num, max_rate):
+        """Limits the commands per second sent to one servo (None or 0 for no limit)"""
+        self.servos.set_max_rate(servo_num, max_rate)
+
+    def _flush_servos(self):
+        # Also called from the writer thread
+        with self._servo_lock:
+            for servo_num, percentage in self.servos.flush():
+                future = self.connection.send_command(servo_command(servo_num, percentage))
+                self._watch_servo_command(future, servo_num, percentage)
+            due = self.servos.next_due()
+        if due is not None:
+            self.connection.call_at(due, self._flush_servos)
+
+    def _watch_servo_command(self, future, servo_num, percentage):
+        # Called back from the reader or writer thread (without the servo
+        # lock, the writer may hold its own lock while calling back)
+        def done(future):
+            if osps.command_failed(future):
+                self.servos.unsent(servo_num, percentage)
+        future.add_done_callback(done)
+
+
+    def battery_set_display(self, value, frame, blink=False, frame_blink=False):
+        """Sets the battery level display: value is the number of bars (0-5),
+        frame shows the battery outline, blink and frame_blink make them blink"""
+        value = int(value)
+        if (value < 0) or (value > 5):
+            raise ValueError("Battery display value must be in range 0-5")
+        self.battery_display = (value, bool(frame), bool(blink), bool(frame_blink))
+        self.connection.send_command(self._battery_command())
+
+    def _battery_command(self):
+        value, frame, blink, frame_blink = self.battery_display
+        return "!BT="+str(value)+","+str(int(frame))+","+str(int(blink))+","+str(int(frame_blink))
+
+
+    def read_config(self):
+        """Returns the board configuration (BoardConfig), or None if the board didn't answer"""
+        from osp_config import read_config
+        return read_config(self.connection)
+
+    def upload_config(self, config, save=True, verify=True):
+        """Sends the changes needed for the board to hold config (a
+        BoardConfig), and saves them. Returns True on success"""
+        from osp_config import upload_config
+        return upload_config(self.connection, config, save, verify)
+
+    def sync_config(self, config, board_key=None):
+        """Like upload_config(), but returns right away if config was already
+        uploaded to this board (same content hash stored on disk)"""
+        from osp_config import sync_config
+        return sync_config(self.connection, config, board_key)
+
+
+    def _replay_outputs(self):
+        """Sends the whole output state again, in one burst (the board
+        restarted or the port was reconnected)"""
+        commands = []
+        lcd16x2_runs = [] # (index in commands, buffer, row, col, text)
+        servo_positions = [] # (index in commands, servo_num, percentage)
+        for lcd_num, active in self.lcd16x2_backlights.items():
+            commands.append(lcd16x2_backlight_command(lcd_num, active))
+        for buffer in self.lcd16x2_buffers.values():
+            buffer.invalidate()
+            for row, col, text in buffer.flush():
+                lcd16x2_runs.append((len(commands), buffer, row, col, text))
+                commands.append(lcd16x2_command(buffer.lcd_num, row, col, text))
+        with self._servo_lock:
+            self.servos.invalidate()
+            for servo_num, percentage in self.servos.flush():
+                servo_positions.append((len(commands), servo_num, percentage))
+                commands.append(servo_command(servo_num, percentage))
+        if self.battery_display is not None:
+            commands.append(self._battery_command())
+        if commands:
+            futures = self.connection.send_commands(commands)
+            for index, buffer, row, col, text in lcd16x2_runs:
+                self._watch_lcd16x2_run(futures[index], buffer, row, col, text)
+            for index, servo_num, percentage in servo_positions:
+                self._watch_servo_command(futures[index], servo_num, percentage)
 
 
     
     # ========================================================================
     # BOARD -> PC
     
-    def check(self):
-        """Called periodically to check for incoming messages"""
+    def check(self, max_events=None, max_time_ms=None):
+        """Called periodically to check for incoming messages.
+        max_events and max_time_ms limit how many packets are processed and
+        for how long, so one call can't take a whole game frame. Returns how
+        many packets are still waiting (0 once everything was processed)"""
+        connection = self.connection
+        deadline = None
+        if max_time_ms is not None:
+            deadline = time.perf_counter() + max_time_ms / 1000.0
         
-        data = osps.check_packet()
-        while data != None:
-            if "axis" in data:
-                self._process_axes(data["axis"])
+        # Axes coalesced in the reader thread are the most recent state, so
+        # they go first. They stay in their slots until the queue is drained,
+        # and the queue skips the older packets of those axes meanwhile
+        peeked = connection.peek_axes()
+        if peeked is not None:
+            for axis_num in peeked:
+                self._process_axis(axis_num, peeked[axis_num])
+        
+        count = 0
+        drained = False
+        while (max_events is None) or (count < max_events):
+            packet = connection.check_packet()
+            if packet is None:
+                drained = True
+                break
+            kind = packet[0]
+            if kind == PACKET_AXIS:
+                self._process_axis(packet[1], packet[2])
             
-            if "btn" in data:
-                self._process_buttons(data["btn"])
+            elif kind == PACKET_BUTTON:
+                self._process_button(packet[1], packet[2])
 
-            if "rad" in data:
-                self._process_radios(data["rad"])
+            elif kind == PACKET_RADIO:
+                self._process_radios(packet[1])
+            
+            elif kind == PACKET_MESSAGE:
+                self._process_message(packet[1])
             
-            data = osps.check_packet()
+            count += 1
+            if (deadline is not None) and (time.perf_counter() >= deadline):
+                break
+        
+        if drained:
+            # Values which arrived while the queue was processed. Axes
+            # delivered above keep their slots until the next check(), so
+            # each axis is delivered at most once per call
+            axes = connection.check_axes(peeked)
+            if axes is not None:
+                for axis_num in axes:
+                    self._process_axis(axis_num, axes[axis_num])
+        
+        # Board restarted or port reconnected: outputs are sent again once,
+        # even if both happened
+        if self.connection.reconnected:
+            self.connection.reconnected = False
+            self._replay_pending = True
+        if self._replay_pending:
+            self._replay_pending = False
+            self._replay_outputs()
+        
+        # Servo targets held back by the rate limit
+        self._flush_servos()
+        
+        for sink in self.event_sinks:
+            sink.publish()
+        
+        return connection.pending()
+    
+    
+    def wait_for_events(self, timeout=None):
+        """Blocks until there are received events to be processed by check(),
+        or the timeout (in seconds) expires. Returns True if there are events"""
+        return self.connection.wait_for_data(timeout)
     
     
     def run_forever(self):
         while True:
             try:
+                # Wakes up as soon as data arrives. The timeout only keeps
+                # Ctrl+C responsive on platforms where waits can't be interrupted,
+                # or is shorter if a rate limited servo target is due earlier
+                timeout = 0.5
+                servo_due = self.servos.next_due()
+                if servo_due is not None:
+                    timeout = min(timeout, max(0.0, servo_due - time.monotonic()))
+                self.wait_for_events(timeout)
                 self.check()
-                time.sleep(0.01) # 100 Hz processing
             except KeyboardInterrupt:
                 break
     
     
+    def set_axis_curve(self, axis_num, curve):
+        """Sets the response curve of an axis: an AxisCurve, a dict of
+        stages (see AxisCurve.from_options) or None for the plain 0.0-1.0
+        scale. Axis callbacks get the value from the curve"""
+        if curve is None:
+            self.axis_curves.pop(int(axis_num), None)
+        else:
+            from osp_curve import curve_table
+            self.axis_curves[int(axis_num)] = curve_table(curve)
+    
+    
+    def set_axis_filter(self, axis_num, deadband=0, hysteresis=0, min_change=0):
+        """Filters the jitter of one axis (or of all, if axis_num is None),
+        in raw counts (0-1023): readings within deadband of either end snap to
+        the end, changes smaller than min_change are dropped, and so are
+        reversals smaller than hysteresis. All zero disables the filter"""
+        self.connection.axis_filter.set(axis_num, deadband, hysteresis, min_change)
+    
+    
+    def get_drop_counters(self):
+        """Returns a dict with how many received packets were lost or merged due to queue overflow"""
+        return self.connection.get_drop_counters()
+    
+    
+    def add_event_sink(self, sink):
+        """Adds an object receiving every input event processed by check():
+        sink.set_axis(num, raw), sink.set_button(num, pressed) and
+        sink.set_radio(num, active, standby), then sink.publish() once at the
+        end of each check(). E.g. osp_net.EventServer or osp_shm.SharedStateWriter"""
+        self.event_sinks.append(sink)
+    
+    
     def add_function_for_axis(self, func):
         self.axes_callbacks.append(func)
     
@@ -122,37 +407,81 @@ class OpenSimPit:
         self.radio_callbacks.append(func)
 
 
-    def _process_axes(self, axes_data):
-        # axes_data is a dictionary where keys are axis numbers and values are
-        # integers in range 0-1023
-        for axis_num in axes_data:
-            axis_value = float(axes_data[axis_num]) / 1023.0
-            for callback in self.axes_callbacks:
-                callback(axis_num, axis_value)
+    # Callbacks for specific inputs only. nums is one input number or an
+    # iterable of them, e.g. on_button_press(5, func) or on_axis(range(0, 3), func).
+    # The arguments given to func are the same as with add_function_for_*()
+    
+    def on_axis(self, nums, func):
+        self.axis_dispatch.add(nums, func)
+
+    def on_button_state(self, nums, func):
+        self.button_state_dispatch.add(nums, func)
+
+    def on_button_press(self, nums, func):
+        self.press_dispatch.add(nums, func)
+
+    def on_button_release(self, nums, func):
+        self.release_dispatch.add(nums, func)
+
+    def on_radio_data(self, nums, func):
+        self.radio_dispatch.add(nums, func)
+
+    def remove_function(self, func):
+        """Removes func from every callback list and input binding"""
+        for callbacks in (self.axes_callbacks, self.buttons_callbacks, self.press_callbacks, self.release_callbacks, self.radio_callbacks):
+            while func in callbacks:
+                callbacks.remove(func)
+        for dispatch in (self.axis_dispatch, self.button_state_dispatch, self.press_dispatch, self.release_dispatch, self.radio_dispatch):
+            dispatch.remove(func)
+
+
+    def _process_message(self, data):
+        if data.get("msg") == "INIT":
+            # Board restarted, the displays no longer show what was sent
+            # and the servos are back to their initial position
+            self._replay_pending = True
+    
+    def _process_axis(self, axis_num, raw_value):
+        # axis_num is an integer, raw_value is an integer in range 0-1023
+        value = curve_value(self.axis_curves, axis_num, raw_value)
+        for sink in self.event_sinks:
+            sink.set_axis(axis_num, raw_value)
+        for callback in self.axes_callbacks:
+            callback(axis_num, value)
+        for callback in self.axis_dispatch.get(axis_num):
+            callback(axis_num, value)
         
-    def _process_buttons(self, buttons_data):
-        # buttons_data is a dictionary where keys are button numbers and values are
-        # an integer as 0 or 1
-        for btn_num in buttons_data:
-            btn_value = (buttons_data[btn_num] != 0)
-            # State callbacks
-            for callback in self.buttons_callbacks:
-                callback(btn_num, btn_value)
-            # Press callbacks - only on rising edge
-            if btn_value:
-                for callback in self.press_callbacks:
-                    callback(btn_num)
-            # Release callbacks - only on falling edge
-            else:
-                for callback in self.release_callbacks:
-                    callback(btn_num)
+    def _process_button(self, btn_num, raw_value):
+        # raw_value is an integer as 0 or 1
+        btn_value = (raw_value != 0)
+        for sink in self.event_sinks:
+            sink.set_button(btn_num, btn_value)
+        # State callbacks
+        for callback in self.buttons_callbacks:
+            callback(btn_num, btn_value)
+        for callback in self.button_state_dispatch.get(btn_num):
+            callback(btn_num, btn_value)
+        # Press callbacks - only on rising edge
+        if btn_value:
+            for callback in self.press_callbacks:
+                callback(btn_num)
+            for callback in self.press_dispatch.get(btn_num):
+                callback(btn_num)
+        # Release callbacks - only on falling edge
+        else:
+            for callback in self.release_callbacks:
+                callback(btn_num)
+            for callback in self.release_dispatch.get(btn_num):
+                callback(btn_num)
     
     def _process_radios(self, radio_data):
-        # radio_data is a dictionary where keys are radio indices:
+        # radio_data is a tuple of (radio_num, active, standby) items, where radio_num is:
         # 0: COM1  1: COM2  2: NAV1  3: NAV2
-        # and values are a list with 2 items: active and standby frequencies (float)
-        # E.g. {"0":[101.5,108.25],"1":[120.0,121.0],"2":[98.5, 110.5],"3":[130.0,131.5]}
-        for radio_num in radio_data:
-            freqs = radio_data[radio_num]
+        # and active and standby are the frequencies (float)
+        for radio_num, active, standby in radio_data:
+            for sink in self.event_sinks:
+                sink.set_radio(radio_num, active, standby)
             for callback in self.radio_callbacks:
-                callback(radio_num, freqs[0], freqs[1]) # Number, active, standby
\ No newline at end of file
+                callback(radio_num, active, standby)
+            for callback in self.radio_dispatch.get(radio_num):
+                callback(radio_num, active, standby)
@@ -0,0 +1,317 @@
+import asyncio, os
+from collections import deque
+
+from serial import Serial
+from serial.serialutil import SerialException
+
+import osp_serial as osps
+from osp_decode import decode_fast, decode_json, curve_value, PACKET_AXIS, PACKET_BUTTON, PACKET_RADIO, PACKET_MESSAGE
+from osp_lcd import lcd16x2_command, lcd16x2_backlight_command
+from osp_servo import servo_command
+from osp_queue import ReceiveQueue, DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST
+from osp_filter import AxisFilter
+from osp_curve import curve_table
+from osp_writer import BLIND_BOARDS, MAX_LOST_ANSWERS
+
+
+READ_SIZE = 4096
+
+
+class AsyncOpenSimPit:
+    """
+    OpenSimPit Python SDK for asyncio applications.
+    The serial port is read from the event loop itself (loop.add_reader), so
+    there are no helper threads and no polling. Only available for serial
+    ports exposing fileno() (posix).
+
+    Usage:
+        osp = AsyncOpenSimPit('/dev/ttyACM0')
+        await osp.open()
+        await osp.lcd16x2_message(0, 0, 0, "Hello")
+        async for event in osp.events():
+            ...
+
+    Events are tuples:
+        (PACKET_AXIS, axis_num, value)                value is a float 0.0-1.0 (or from the axis curve)
+        (PACKET_BUTTON, btn_num, value)               value is True/False
+        (PACKET_RADIO, radio_num, active, standby)    frequencies as floats
+    """
+
+    def __init__(self, serial_port, queue_size=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST, coalesce_axes=False, coalesce_backlog=None, flow_control=True):
+        # Without flow_control (or when it falls back, like in osp_writer),
+        # commands are written without waiting for the board answers
+        self.port = serial_port
+        self.flow_control = flow_control
+        self.blind = False
+        self.lost_answers = 0
+        self.ser = None
+        self.loop = None
+        self.received_queue = ReceiveQueue(queue_size, overflow_policy, coalesce_axes, coalesce_backlog)
+        self.axis_filter = AxisFilter()
+        self.axis_curves = {}
+
+        self._fd = None
+        self._buffer = bytearray()
+        self._out_buffer = bytearray()
+        self._has_data = None # asyncio.Event, created in open()
+        self._pending = deque() # Futures waiting for OK/ERROR, in sending order
+        self._closed_exc = None
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self._has_data = asyncio.Event()
+
+        self.ser = Serial()
+        self.ser.baudrate = osps.BAUDRATE
+        self.ser.port = self.port
+        try:
+            self.ser.open()
+        except SerialException:
+            return False
+        fd = osps.port_fileno(self.ser)
+        if fd is None:
+            self.ser.close()
+            raise NotImplementedError("AsyncOpenSimPit requires a posix serial port")
+
+        self._fd = fd
+        self._closed_exc = None
+        self.loop.add_reader(self._fd, self._on_readable)
+        return True
+
+    def close(self):
+        self._connection_lost(None)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+    # ========================================================================
+    # PC -> BOARD
+
+    def send_command(self, data, timeout=osps.DEFAULT_COMMAND_TIMEOUT):
+        """Sends a command and returns an awaitable resolving to True if the
+        board answered OK, or False if it answered ERROR (None without
+        flow control, as soon as it is written)"""
+        if self._fd is None:
+            raise ConnectionError("Serial port is not open")
+        if osps.is_debug:
+            print("> Sending: "+data)
+
+        future = self.loop.create_future()
+        if self.blind or not self.flow_control:
+            self._write((data+'\n').encode('utf-8'))
+            future.set_result(None)
+            return future
+
+        self._pending.append((future, self.loop.time() + timeout))
+        self._write((data+'\n').encode('utf-8'))
+        return self._wait_answer(future, timeout)
+
+    async def _wait_answer(self, future, timeout):
+        # Shielded, so a timeout doesn't remove the future from the pending
+        # queue before answers arriving meanwhile are matched
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # Stays in the pending queue until an answer skips it
+            future.cancel()
+            self.lost_answers += 1
+            if self.lost_answers >= MAX_LOST_ANSWERS:
+                self.blind = True
+            raise
+
+    async def lcd16x2_clear(self, lcd_num):
+        return await self.send_command("!LCC="+str(int(lcd_num)))
+
+    async def lcd16x2_set_backlight(self, lcd_num, active):
+        return await self.send_command(lcd16x2_backlight_command(lcd_num, active))
+
+    async def lcd16x2_message(self, lcd_num, row, col, message):
+        return await self.send_command(lcd16x2_command(lcd_num, row, col, message))
+
+    async def servo_set_position(self, servo_num, percentage):
+        return await self.send_command(servo_command(servo_num, percentage))
+
+    async def battery_set_display(self, value, frame, blink=False, frame_blink=False):
+        return await self.send_command("!BT="+str(int(value))+","+str(int(bool(frame)))+","+str(int(bool(blink)))+","+str(int(bool(frame_blink))))
+
+
+    # ========================================================================
+    # BOARD -> PC
+
+    def set_axis_filter(self, axis_num, deadband=0, hysteresis=0, min_change=0):
+        """Filters the jitter of one axis (or all, if axis_num is None), see osp_filter"""
+        self.axis_filter.set(axis_num, deadband, hysteresis, min_change)
+
+    def set_axis_curve(self, axis_num, curve):
+        """Sets the response curve of an axis (AxisCurve, dict of stages or None)"""
+        if curve is None:
+            self.axis_curves.pop(int(axis_num), None)
+        else:
+            self.axis_curves[int(axis_num)] = curve_table(curve)
+
+    async def events(self):
+        """Asynchronous iterator over input events. Ends when the port is closed"""
+        queue = self.received_queue
+        while True:
+            # Latest axis values first, the queue skips their older packets
+            peeked = queue.peek_axes()
+            if peeked is not None:
+                for axis_num in peeked:
+                    yield (PACKET_AXIS, axis_num, curve_value(self.axis_curves, axis_num, peeked[axis_num]))
+
+            packet = queue.get()
+            while packet is not None:
+                kind = packet[0]
+                if kind == PACKET_AXIS:
+                    yield (PACKET_AXIS, packet[1], curve_value(self.axis_curves, packet[1], packet[2]))
+                elif kind == PACKET_BUTTON:
+                    yield (PACKET_BUTTON, packet[1], packet[2] != 0)
+                elif kind == PACKET_RADIO:
+                    for radio_num, active, standby in packet[1]:
+                        yield (PACKET_RADIO, radio_num, active, standby)
+                packet = queue.get()
+
+            # Queue drained, the slots can be emptied (except the ones just
+            # delivered, for the next round)
+            axes = queue.take_axes(peeked)
+            if axes is not None:
+                for axis_num in axes:
+                    yield (PACKET_AXIS, axis_num, curve_value(self.axis_curves, axis_num, axes[axis_num]))
+
+            if len(queue) > 0:
+                continue # Received while the events were handled
+
+            if self._fd is None:
+                if isinstance(self._closed_exc, Exception):
+                    raise self._closed_exc
+                return
+
+            self._has_data.clear()
+            await self._has_data.wait()
+
+
+    # ========================================================================
+    # EVENT LOOP CALLBACKS
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        if not data:
+            self._connection_lost(ConnectionError('device reports readiness to read but returned no data'))
+            return
+
+        buffer = self._buffer
+        buffer.extend(data)
+        start = 0
+        end = buffer.find(b'\n')
+        while end >= 0:
+            self._handle_line(buffer[start:end])
+            start = end + 1
+            end = buffer.find(b'\n', start)
+        del buffer[:start]
+
+        self._has_data.set()
+
+    def _handle_line(self, line):
+        if osps.is_debug:
+            print("> Received: "+line.decode('utf-8', 'replace').rstrip())
+
+        decoded = decode_fast(line)
+        if decoded is not None:
+            if decoded[0] == PACKET_AXIS:
+                decoded = self.axis_filter.filter_packet(decoded)
+                if decoded is None:
+                    return
+            self.received_queue.put(decoded)
+            return
+
+        decoded = decode_json(line)
+        if decoded is None:
+            return
+        for item in decoded:
+            if item[0] == PACKET_MESSAGE:
+                self._handle_message(item[1])
+            elif item[0] == PACKET_AXIS:
+                item = self.axis_filter.filter_packet(item)
+                if item is not None:
+                    self.received_queue.put(item)
+            else:
+                self.received_queue.put(item)
+
+    def _handle_message(self, data):
+        msg = data.get("msg")
+        if msg in ("OK", "AT OK", "ERROR"):
+            # The board answers commands strictly in order. Commands past
+            # their timeout are considered lost and skipped
+            now = self.loop.time()
+            while self._pending:
+                future, deadline = self._pending.popleft()
+                if deadline > now:
+                    self.lost_answers = 0
+                    if not future.done():
+                        future.set_result(msg != "ERROR")
+                    break
+                future.cancel()
+        elif msg == "INIT":
+            # Board has restarted, commands in flight are lost
+            self._fail_pending(ConnectionResetError("Board restarted"))
+            self.blind = data.get("board") in BLIND_BOARDS
+            self.lost_answers = 0
+
+    def _write(self, data):
+        if self._out_buffer:
+            self._out_buffer.extend(data)
+            return
+        try:
+            written = os.write(self._fd, data)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        if written < len(data):
+            self._out_buffer.extend(data[written:])
+            self.loop.add_writer(self._fd, self._on_writable)
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._fd, self._out_buffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        del self._out_buffer[:written]
+        if not self._out_buffer:
+            self.loop.remove_writer(self._fd)
+
+    def _fail_pending(self, exc):
+        while self._pending:
+            future, deadline = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    def _connection_lost(self, exc):
+        if self._fd is None:
+            return
+        if osps.is_debug:
+            print("Serial connection lost: "+str(exc))
+        self.loop.remove_reader(self._fd)
+        if self._out_buffer:
+            self.loop.remove_writer(self._fd)
+            self._out_buffer.clear()
+        self._fd = None
+        self._closed_exc = exc
+        self.ser.close()
+        self._fail_pending(exc if exc is not None else ConnectionError("Serial port closed"))
+        self._has_data.set()
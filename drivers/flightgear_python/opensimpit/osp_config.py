@@ -0,0 +1,260 @@
+import os
+from collections import namedtuple
+
+from osp_decode import NUMBER_OF_AXES, NUMBER_OF_BUTTONS, AXIS_MIN, AXIS_MAX
+
+
+# ============================================================================
+# BOARD CONFIGURATION
+#
+# Model of the configuration kept by the main board (axes, buttons, I/O
+# expanders and 16x2 LCDs), as reported by DUMP and set by the AXIS=,
+# BTN=, EXP= and LCD16X2= commands.
+#
+# The firmware only appends axes and buttons, and LCDs can only be
+# disabled all at once, with CLEAR (which keeps the number of expanders).
+# The uploader reads the current configuration with DUMP, and only sends
+# what is missing when the board holds a prefix of the wanted lists, or
+# CLEAR and everything otherwise. Commands are pipelined: they are queued
+# at once and the OK/ERROR answers pace them (see osp_writer), instead of
+# waiting for each answer before sending the next command.
+#
+# Each configuration has a content hash. After a successful upload, the hash
+# is stored on disk for the board (by USB identity), so next time a driver
+# starts with the same configuration, sync_config() skips the upload and
+# the DUMP validation altogether.
+
+NUMBER_MAX_EXPANDERS = 8
+NUMBER_MAX_LCD16X2 = 8
+
+DUMP_TIMEOUT = 2.0 # seconds
+SAVE_TIMEOUT = 5.0 # seconds, writing the EEPROM is slow on AVR boards
+
+DEFAULT_HASH_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.opensimpit_configs.json')
+
+
+# Items of the axes and buttons lists (tuples, with the fields in DUMP order)
+AxisConfig = namedtuple('AxisConfig', ('pin', 'axis', 'vmin', 'vmax'))
+ButtonConfig = namedtuple('ButtonConfig', ('expander', 'pin', 'button', 'invert', 'toggle'))
+
+
+class BoardConfig:
+    """
+    Configuration of one main board. axes (AxisConfig) and buttons
+    (ButtonConfig) are in the same order as the board keeps them.
+    lcd16x2 maps enabled LCD numbers to their I2C address index (0-7).
+    board and version are only informative (from DUMP), they are not part
+    of the comparison nor of the hash.
+    """
+    __slots__ = ('axes', 'buttons', 'used_expanders', 'lcd16x2', 'board', 'version')
+
+    def __init__(self, axes=None, buttons=None, used_expanders=0, lcd16x2=None, board=None, version=None):
+        self.axes = [AxisConfig(*item) for item in axes] if axes else []
+        self.buttons = [ButtonConfig(*item) for item in buttons] if buttons else []
+        self.used_expanders = used_expanders
+        self.lcd16x2 = dict(lcd16x2) if lcd16x2 else {}
+        self.board = board
+        self.version = version
+
+    @classmethod
+    def from_dump(cls, data):
+        """Builds the configuration from the dict of a DUMP answer.
+        Raises ValueError if the dict is not a valid DUMP"""
+        try:
+            axes = []
+            for i in range(int(data.get("used_axes", 0))):
+                pin, axis, vmin, vmax = data["axes"][str(i)]
+                axes.append(AxisConfig(int(pin), int(axis), int(vmin), int(vmax)))
+            buttons = []
+            for i in range(int(data.get("used_buttons", 0))):
+                exp, pin, btn, invert, toggle = data["buttons"][str(i)]
+                buttons.append(ButtonConfig(int(exp), int(pin), int(btn), bool(invert), bool(toggle)))
+            lcd16x2 = {}
+            for lcd_num, item in data.get("lcd16x2", {}).items():
+                status, address_index = item
+                if status:
+                    lcd16x2[int(lcd_num)] = int(address_index)
+            used_expanders = int(data.get("used_expanders", 0))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError("Invalid DUMP: "+str(e))
+        return cls(axes, buttons, used_expanders, lcd16x2, data.get("board"), data.get("ver"))
+
+    def content_hash(self):
+        """Returns a hash (hex string) of the configuration contents. It only
+        depends on what the board is configured to do, so it is stable across
+        runs, SDK versions and platforms"""
+        import hashlib
+        text = "A"+";".join(",".join(str(int(value)) for value in item) for item in self.axes)
+        text += "|B"+";".join(",".join(str(int(value)) for value in item) for item in self.buttons)
+        text += "|E"+str(int(self.used_expanders))
+        text += "|L"+";".join(str(lcd_num)+"="+str(self.lcd16x2[lcd_num]) for lcd_num in sorted(self.lcd16x2))
+        return hashlib.blake2b(text.encode('ascii'), digest_size=8).hexdigest()
+
+    def add_axis(self, pin, axis, vmin=AXIS_MIN, vmax=AXIS_MAX):
+        """Maps the analog pin (0-5) to the joystick axis (0-5). vmin and vmax
+        are the raw readings taken as the ends of the axis"""
+        if (len(self.axes) >= NUMBER_OF_AXES) or not (0 <= pin < NUMBER_OF_AXES) or not (0 <= axis < NUMBER_OF_AXES):
+            raise ValueError("Invalid axis")
+        if not (AXIS_MIN <= vmin <= AXIS_MAX) or not (AXIS_MIN <= vmax <= AXIS_MAX):
+            raise ValueError("Axis range must be within "+str(AXIS_MIN)+"-"+str(AXIS_MAX))
+        self.axes.append(AxisConfig(int(pin), int(axis), int(vmin), int(vmax)))
+
+    def add_button(self, exp, pin, btn, invert=False, toggle=False):
+        """Maps the pin (0-7) of the I/O expander (0-7) to the joystick button (0-31)"""
+        if (len(self.buttons) >= NUMBER_OF_BUTTONS) or not (0 <= exp < NUMBER_MAX_EXPANDERS) or not (0 <= pin < 8) or not (0 <= btn < NUMBER_OF_BUTTONS):
+            raise ValueError("Invalid button")
+        self.buttons.append(ButtonConfig(int(exp), int(pin), int(btn), bool(invert), bool(toggle)))
+
+    def set_expanders(self, count):
+        # The firmware takes up to NUMBER_MAX_EXPANDERS - 1
+        if not (0 <= count < NUMBER_MAX_EXPANDERS):
+            raise ValueError("Invalid number of expanders")
+        self.used_expanders = int(count)
+
+    def add_lcd16x2(self, address_index, lcd_num):
+        if not (0 <= address_index < 8) or not (0 <= lcd_num < NUMBER_MAX_LCD16X2):
+            raise ValueError("Invalid LCD")
+        self.lcd16x2[int(lcd_num)] = int(address_index)
+
+    def __eq__(self, other):
+        return isinstance(other, BoardConfig) and (
+            (self.axes == other.axes) and (self.buttons == other.buttons) and
+            (self.used_expanders == other.used_expanders) and (self.lcd16x2 == other.lcd16x2))
+
+    def __repr__(self):
+        return "BoardConfig(axes="+repr(self.axes)+", buttons="+repr(self.buttons)+", used_expanders="+repr(self.used_expanders)+", lcd16x2="+repr(self.lcd16x2)+")"
+
+
+# ============================================================================
+# COMMANDS
+
+def axis_command(pin, axis, vmin, vmax):
+    if (vmin, vmax) == (AXIS_MIN, AXIS_MAX):
+        return "AXIS="+str(pin)+","+str(axis)
+    return "AXIS="+str(pin)+","+str(axis)+","+str(vmin)+","+str(vmax)
+
+def button_command(exp, pin, btn, invert, toggle):
+    if not (invert or toggle):
+        return "BTN="+str(exp)+","+str(pin)+","+str(btn)
+    return "BTN="+str(exp)+","+str(pin)+","+str(btn)+","+str(int(invert))+","+str(int(toggle))
+
+def lcd16x2_config_command(address_index, lcd_num):
+    return "LCD16X2="+str(address_index)+","+str(lcd_num)
+
+
+def plan_upload(current, wanted):
+    """Returns the list of commands turning the current configuration (as
+    read from the board) into the wanted one. Empty if they are equal"""
+    commands = []
+    if wanted.used_expanders != current.used_expanders:
+        commands.append("EXP="+str(wanted.used_expanders))
+
+    # Appending is enough if the board holds the beginning of the wanted
+    # lists and no LCD which should be disabled
+    can_append = (
+        (current.axes == wanted.axes[:len(current.axes)]) and
+        (current.buttons == wanted.buttons[:len(current.buttons)]) and
+        all((lcd_num in wanted.lcd16x2) for lcd_num in current.lcd16x2))
+
+    if can_append:
+        axes = wanted.axes[len(current.axes):]
+        buttons = wanted.buttons[len(current.buttons):]
+        lcds = [(lcd_num, address_index) for lcd_num, address_index in wanted.lcd16x2.items()
+                if current.lcd16x2.get(lcd_num) != address_index]
+    else:
+        commands.append("CLEAR")
+        axes = wanted.axes
+        buttons = wanted.buttons
+        lcds = list(wanted.lcd16x2.items())
+
+    for item in axes:
+        commands.append(axis_command(*item))
+    for item in buttons:
+        commands.append(button_command(*item))
+    for lcd_num, address_index in sorted(lcds):
+        commands.append(lcd16x2_config_command(address_index, lcd_num))
+    return commands
+
+
+# ============================================================================
+# UPLOAD
+
+def read_config(connection, timeout=DUMP_TIMEOUT):
+    """Reads the configuration of the board with DUMP. Returns a
+    BoardConfig, or None if the board didn't answer"""
+    connection.config = None
+    try:
+        if not connection.send_command("DUMP", timeout).result():
+            return None
+    except OSError:
+        return None
+    return connection.config
+
+
+def upload_config(connection, config, save=True, verify=True):
+    """
+    Makes the board configuration equal to config, sending only the
+    commands needed, then SAVE (to keep it after restarts) if anything
+    changed. With verify, the result is checked with a final DUMP.
+    Returns True on success, False if the board rejected a command, didn't
+    answer, or doesn't hold the wanted configuration at the end.
+    """
+    current = read_config(connection)
+    if current is None:
+        return False
+    commands = plan_upload(current, config)
+    if not commands:
+        return True
+
+    # All queued at once, the answers are checked at the end
+    futures = connection.send_commands(commands)
+    if save:
+        futures.append(connection.send_command("SAVE", SAVE_TIMEOUT))
+    try:
+        for future in futures:
+            if not future.result():
+                return False
+    except OSError:
+        return False
+
+    if verify:
+        return read_config(connection) == config
+    return True
+
+
+def sync_config(connection, config, board_key=None, cache_path=DEFAULT_HASH_CACHE_PATH, save=True):
+    """
+    Like upload_config(), but if the hash of config is the one stored for
+    board_key after the last successful upload, returns True right away,
+    without reading the board. board_key identifies the board (e.g. its USB
+    serial number). If None, it is looked up from the port of the
+    connection, and the board is always checked if it has no USB identity.
+    """
+    if board_key is None:
+        from osp_discovery import device_key
+        board_key = device_key(connection.port)
+
+    config_hash = config.content_hash()
+    if (board_key is not None) and (cache_path is not None):
+        if load_config_hashes(cache_path).get(board_key) == config_hash:
+            return True
+
+    if not upload_config(connection, config, save, verify=True):
+        return False
+
+    if (board_key is not None) and (cache_path is not None):
+        hashes = load_config_hashes(cache_path)
+        hashes[board_key] = config_hash
+        save_config_hashes(cache_path, hashes)
+    return True
+
+
+def load_config_hashes(path=DEFAULT_HASH_CACHE_PATH):
+    """Returns the dict of board key -> hash of the configuration last uploaded"""
+    from osp_discovery import load_json_cache
+    return load_json_cache(path)
+
+
+def save_config_hashes(path, hashes):
+    from osp_discovery import save_json_cache
+    save_json_cache(path, hashes)
@@ -0,0 +1,192 @@
+import os, threading, time
+
+import osp_serial as osps
+
+
+# ============================================================================
+# BOARD DISCOVERY
+#
+# Finds OpenSimPit boards among the serial ports of the computer. All the
+# candidate ports are probed at the same time: each one is opened and
+# waited for INIT (boards restarting on open) or an answer to AT, and the
+# board model is taken from INIT or, if needed, from DUMP. The radio module
+# reports itself as board "Radio" in its INIT message.
+#
+# USB devices are identified by VID:PID and serial number (or USB location,
+# for adapters without serial number), and what was found on each one is
+# cached on disk, so later discoveries only probe devices never seen before.
+# Devices which opened but didn't answer are cached with the probe time, and
+# probed again after NEGATIVE_CACHE_TIME (e.g. a board flashed meanwhile).
+# Ports which couldn't be opened (busy, no permission) are not cached.
+
+ROLE_MAIN = 'main'
+ROLE_RADIO = 'radio'
+
+RADIO_BOARD = "Radio"
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.opensimpit_ports.json')
+DEFAULT_PROBE_TIMEOUT = osps.DEFAULT_READY_TIMEOUT # seconds
+NEGATIVE_CACHE_TIME = 3600.0 # seconds
+
+
+class DiscoveredBoard:
+    """
+    One OpenSimPit board found on a serial port.
+    role is ROLE_MAIN or ROLE_RADIO, board is the model reported by the
+    firmware, and key is the USB identity of the port (None if unknown).
+    """
+
+    def __init__(self, port, board, key=None):
+        self.port = port
+        self.board = board
+        self.role = board_role(board)
+        self.key = key
+
+    def __repr__(self):
+        return "DiscoveredBoard("+repr(self.port)+", "+repr(self.board)+", "+repr(self.key)+")"
+
+
+def board_role(board):
+    return ROLE_RADIO if (board == RADIO_BOARD) else ROLE_MAIN
+
+
+def port_key(port_info):
+    """Returns a string identifying the USB device behind a port (from
+    serial.tools.list_ports), or None if it is not a USB device"""
+    if getattr(port_info, 'vid', None) is None:
+        return None
+    key = "{:04X}:{:04X}".format(port_info.vid, port_info.pid or 0)
+    if port_info.serial_number:
+        return key+":"+port_info.serial_number
+    # Cheap USB serial adapters share VID:PID and have no serial number
+    return key+"@"+str(port_info.location)
+
+
+def device_key(port):
+    """Returns the port_key() of the USB device behind a port name, or None"""
+    from serial.tools import list_ports
+    for info in list_ports.comports():
+        if (info.device == port) or (os.path.realpath(info.device) == os.path.realpath(port)):
+            return port_key(info)
+    return None
+
+
+def probe_port(port, timeout=DEFAULT_PROBE_TIMEOUT):
+    """Opens the port and returns the board model reported by the firmware,
+    or None if there is no OpenSimPit board on it. Raises OSError if the
+    port can't be opened"""
+    connection = osps.OSPConnection(auto_reconnect=False)
+    try:
+        if not connection.open(port):
+            raise OSError("Could not open "+str(port))
+        ready = connection.wait_ready(timeout)
+        if ready and (connection.board is None):
+            # Answered AT without restarting: the model comes with DUMP
+            try:
+                connection.send_command("DUMP", timeout).result()
+            except OSError:
+                pass
+        return connection.board
+    finally:
+        connection.close()
+
+
+def discover(ports=None, timeout=DEFAULT_PROBE_TIMEOUT, cache_path=DEFAULT_CACHE_PATH, use_cache=True):
+    """
+    Returns the list of DiscoveredBoard found, sorted by port name.
+    ports is a list of port names (or serial.tools.list_ports entries) to
+    look at. If None, all USB serial ports of the computer are used.
+    Devices in the cache are not probed (unless use_cache is False, or
+    nothing was found on them NEGATIVE_CACHE_TIME ago), and the cache is
+    updated with the devices probed. Set cache_path to None to disable the
+    cache file.
+    """
+    if ports is None:
+        from serial.tools import list_ports
+        ports = [info for info in list_ports.comports() if info.vid is not None]
+
+    cache = load_json_cache(cache_path) if (cache_path is not None) else {}
+    now = time.time()
+    found = []
+    to_probe = []
+    for info in ports:
+        port = getattr(info, 'device', info)
+        key = port_key(info)
+        # Cached values are the board model, or the time nothing was found
+        cached = cache.get(key) if (use_cache and (key is not None)) else None
+        if isinstance(cached, str):
+            found.append(DiscoveredBoard(port, cached, key))
+        elif not (isinstance(cached, (int, float)) and (0 <= now - cached < NEGATIVE_CACHE_TIME)):
+            to_probe.append((port, key))
+
+    # One thread per port, so the total time is the one of the slowest port.
+    # Ports which failed (e.g. couldn't be opened) are left out of results
+    results = {}
+    def probe(port):
+        try:
+            results[port] = probe_port(port, timeout)
+        except Exception:
+            pass
+    threads = [threading.Thread(target=probe, args=(port,), daemon=True) for port, key in to_probe]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache_changed = False
+    for port, key in to_probe:
+        if port not in results:
+            continue
+        board = results[port]
+        if board is not None:
+            found.append(DiscoveredBoard(port, board, key))
+        if key is not None:
+            # Devices without OpenSimPit are cached too, so they are not
+            # probed again for a while
+            cache[key] = board if (board is not None) else now
+            cache_changed = True
+    if cache_changed and (cache_path is not None):
+        save_json_cache(cache_path, cache)
+
+    found.sort(key=lambda item: item.port)
+    return found
+
+
+def find_port(role=ROLE_MAIN, **kwargs):
+    """Returns the port of the first board found with the given role, or
+    None. Keyword arguments are passed to discover()"""
+    for item in discover(**kwargs):
+        if item.role == role:
+            return item.port
+    return None
+
+
+def forget(cache_path=DEFAULT_CACHE_PATH):
+    """Deletes the cache file, so the next discovery probes every port"""
+    try:
+        os.remove(cache_path)
+    except FileNotFoundError:
+        pass
+
+
+def load_json_cache(path):
+    """Returns the dict stored in a JSON cache file (empty if missing or invalid)"""
+    import json
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if (type(cache) is dict) else {}
+
+
+def save_json_cache(path, cache):
+    import json
+    # Written aside and renamed, so concurrent readers never see half a file
+    temp_path = path+".tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
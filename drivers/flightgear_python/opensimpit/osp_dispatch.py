@@ -0,0 +1,56 @@
+# ============================================================================
+# CALLBACK DISPATCH TABLES
+#
+# Callbacks registered for specific input numbers (e.g. only button 5, or
+# axes 0-2) are kept in a list indexed by input number, where each item is
+# the tuple of callbacks for that input. Tuples are rebuilt when callbacks
+# are added or removed, never while dispatching, so an event costs one
+# list index and only the callbacks bound to that input are called, no
+# matter how many bindings exist for other inputs.
+
+
+def input_numbers(nums):
+    """Returns the list of input numbers from an int or an iterable of ints
+    (list, range, ...). Raises ValueError for negative numbers"""
+    if isinstance(nums, int):
+        nums = (nums,)
+    result = [int(num) for num in nums]
+    for num in result:
+        if num < 0:
+            raise ValueError("Invalid input number: "+str(num))
+    return result
+
+
+class DispatchTable:
+    """
+    Callbacks by input number. table[num] is the tuple of callbacks for
+    input num, and the table grows as needed when callbacks are added.
+    """
+    __slots__ = ('table',)
+
+    def __init__(self, size=0):
+        self.table = [()] * size
+
+    def add(self, nums, func):
+        """Binds func to one input number, or to each number of an iterable"""
+        nums = input_numbers(nums)
+        table = self.table
+        if nums and (max(nums) >= len(table)):
+            table.extend([()] * (max(nums) + 1 - len(table)))
+        for num in nums:
+            if func not in table[num]:
+                table[num] = table[num] + (func,)
+
+    def remove(self, func, nums=None):
+        """Unbinds func from the given input numbers (or from all if None)"""
+        table = self.table
+        if nums is None:
+            nums = range(len(table))
+        for num in input_numbers(nums):
+            if (num < len(table)) and (func in table[num]):
+                table[num] = tuple(callback for callback in table[num] if callback != func)
+
+    def get(self, num):
+        """Returns the tuple of callbacks bound to input num"""
+        table = self.table
+        return table[num] if (0 <= num < len(table)) else ()
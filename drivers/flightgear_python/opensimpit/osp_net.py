@@ -0,0 +1,508 @@
+import socket, select, struct, threading, time
+from collections import deque
+
+from osp_decode import PACKET_AXIS, PACKET_BUTTON, PACKET_RADIO
+
+
+# ============================================================================
+# NETWORK EVENT FAN-OUT
+#
+# Rebroadcasts the input events of one OpenSimPit to other computers, over
+# TCP and/or UDP (unicast to subscribers, and optionally multicast).
+#
+# All the events of one check() go in one packet:
+#     header   4s magic "OSPN", B flags, I sequence, H number of records
+#     records  B kind, B number, then:
+#                  axis:    H raw value (0-1023)
+#                  button:  B value (0/1)
+#                  radio:   I active, I standby (kHz)
+# Packets with FLAG_SNAPSHOT hold the whole current state instead of the
+# changes. Sequence numbers grow by one per packet of events, and snapshots
+# carry the sequence of the last one, so clients can detect lost packets
+# (and UDP clients ask for a snapshot again).
+#
+# TCP: each packet is prefixed with its size (H). A snapshot is sent as
+# soon as a client connects.
+# UDP: clients subscribe by sending a datagram to the server port (and
+# keep doing so at least every UDP_SUBSCRIPTION_TIMEOUT seconds). Each
+# subscription datagram is answered with a snapshot. Datagrams starting
+# with MAGIC are event packets (e.g. multicast looped back to the server
+# host), never subscriptions. With a multicast group, packets also go to
+# the group, from a socket of their own and on a port of their own, with a
+# snapshot every MULTICAST_SNAPSHOT_INTERVAL seconds for late joiners.
+# Group members ask for a snapshot with SNAPSHOT_REQUEST instead, which
+# doesn't subscribe them (they would get every packet twice).
+
+MAGIC = b'OSPN'
+FLAG_SNAPSHOT = 0x01
+SUBSCRIBE = b'S'
+SNAPSHOT_REQUEST = b'R'
+
+HEADER_STRUCT = struct.Struct('<4sBIH')
+FRAME_STRUCT = struct.Struct('<H')
+AXIS_STRUCT = struct.Struct('<BBH')
+BUTTON_STRUCT = struct.Struct('<BBB')
+RADIO_STRUCT = struct.Struct('<BBII')
+
+DEFAULT_NET_PORT = 5410
+DEFAULT_MULTICAST_PORT = 5411
+MAX_DATAGRAM = 1400 # bytes, below the usual MTU
+UDP_SUBSCRIPTION_TIMEOUT = 10.0 # seconds
+MULTICAST_SNAPSHOT_INTERVAL = 1.0 # seconds
+MAX_CLIENT_BUFFER = 65536 # bytes pending to a TCP client before dropping it
+
+
+def _khz(frequency):
+    return int(round(frequency * 1000.0))
+
+
+def encode_records(records):
+    """Encodes a list of (kind, number, value...) events into record bytes"""
+    data = bytearray()
+    for record in records:
+        kind = record[0]
+        if kind == PACKET_AXIS:
+            data += AXIS_STRUCT.pack(kind, record[1], record[2])
+        elif kind == PACKET_BUTTON:
+            data += BUTTON_STRUCT.pack(kind, record[1], 1 if record[2] else 0)
+        elif kind == PACKET_RADIO:
+            data += RADIO_STRUCT.pack(kind, record[1], _khz(record[2]), _khz(record[3]))
+    return data
+
+
+def decode_packet(data):
+    """Decodes a packet. Returns (sequence, flags, records) where records is a
+    list of (PACKET_AXIS, num, raw), (PACKET_BUTTON, num, bool) or
+    (PACKET_RADIO, num, active, standby), or None if it is not a valid packet"""
+    if len(data) < HEADER_STRUCT.size:
+        return None
+    magic, flags, sequence, count = HEADER_STRUCT.unpack_from(data, 0)
+    if magic != MAGIC:
+        return None
+    records = []
+    offset = HEADER_STRUCT.size
+    try:
+        for i in range(count):
+            kind = data[offset]
+            if kind == PACKET_AXIS:
+                kind, num, raw = AXIS_STRUCT.unpack_from(data, offset)
+                records.append((kind, num, raw))
+                offset += AXIS_STRUCT.size
+            elif kind == PACKET_BUTTON:
+                kind, num, value = BUTTON_STRUCT.unpack_from(data, offset)
+                records.append((kind, num, value != 0))
+                offset += BUTTON_STRUCT.size
+            elif kind == PACKET_RADIO:
+                kind, num, active, standby = RADIO_STRUCT.unpack_from(data, offset)
+                records.append((kind, num, active / 1000.0, standby / 1000.0))
+                offset += RADIO_STRUCT.size
+            else:
+                return None
+    except (IndexError, struct.error):
+        return None
+    return (sequence, flags, records)
+
+
+# ============================================================================
+# SERVER
+
+class EventServer:
+    """
+    Fan-out server for the events of one OpenSimPit. Attach it with
+    OpenSimPit.add_event_sink(server); each check() then sends the events
+    processed in one packet. Sockets are served by a thread of its own.
+    """
+
+    def __init__(self, tcp_port=DEFAULT_NET_PORT, udp_port=DEFAULT_NET_PORT, host='', multicast_group=None, multicast_port=DEFAULT_MULTICAST_PORT, multicast_ttl=1, multicast_loop=True):
+        # tcp_port/udp_port None disables that transport
+        # With multicast_loop, clients on this computer also get the
+        # multicast packets
+        self.sequence = 0
+        self._lock = threading.Lock()
+        self._pending = [] # Events since the last publish()
+        self._axes = {}
+        self._buttons = {}
+        self._radios = {}
+        self._outbox = deque() # Packets to be sent by the thread
+        self._tcp_clients = {} # socket -> bytearray pending
+        self._udp_clients = {} # address -> last subscription time
+        self._udp_snapshots = deque() # addresses waiting for a snapshot
+        self._last_multicast_snapshot = 0.0
+        self.alive = True
+
+        self.tcp_socket = None
+        if tcp_port is not None:
+            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tcp_socket.bind((host, tcp_port))
+            self.tcp_socket.listen(8)
+            self.tcp_socket.setblocking(False)
+
+        self.udp_socket = None
+        if udp_port is not None:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.udp_socket.bind((host, udp_port))
+            self.udp_socket.setblocking(False)
+
+        self.multicast_address = None
+        self.multicast_socket = None
+        if multicast_group is not None:
+            self.multicast_address = (multicast_group, multicast_port)
+            self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if multicast_loop else 0)
+            self.multicast_socket.setblocking(False)
+
+        # Wakes the thread up when there is something to send
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+        self._wake()
+        self.thread.join(2)
+        for sock in list(self._tcp_clients) + [self.tcp_socket, self.udp_socket, self.multicast_socket, self._wake_r, self._wake_w]:
+            if sock is not None:
+                sock.close()
+
+
+    # ========================================================================
+    # EVENT SINK (called from the thread calling OpenSimPit.check())
+
+    def set_axis(self, axis_num, raw_value):
+        self._axes[axis_num] = raw_value
+        self._pending.append((PACKET_AXIS, axis_num, raw_value))
+
+    def set_button(self, btn_num, pressed):
+        self._buttons[btn_num] = pressed
+        self._pending.append((PACKET_BUTTON, btn_num, pressed))
+
+    def set_radio(self, radio_num, active, standby):
+        self._radios[radio_num] = (active, standby)
+        self._pending.append((PACKET_RADIO, radio_num, active, standby))
+
+    def publish(self):
+        """Sends the events since the last call to every client"""
+        if not self._pending:
+            return
+        packets = self._packets(self._pending, 0)
+        self._pending = []
+        with self._lock:
+            for packet in packets:
+                self._outbox.append(packet)
+        self._wake()
+
+
+    # ========================================================================
+    # PACKETS
+
+    def _snapshot_records(self):
+        # Called from the server thread: list() copies each dict at once
+        records = [(PACKET_AXIS, num, value) for num, value in list(self._axes.items())]
+        records += [(PACKET_BUTTON, num, value) for num, value in list(self._buttons.items())]
+        records += [(PACKET_RADIO, num, values[0], values[1]) for num, values in list(self._radios.items())]
+        return records
+
+    def _packets(self, records, flags):
+        # Splits the records in packets fitting in one datagram
+        packets = []
+        max_records = (MAX_DATAGRAM - HEADER_STRUCT.size) // RADIO_STRUCT.size
+        for start in range(0, max(1, len(records)), max_records):
+            chunk = records[start:start + max_records]
+            with self._lock:
+                if not (flags & FLAG_SNAPSHOT):
+                    self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+                sequence = self.sequence
+            packets.append(HEADER_STRUCT.pack(MAGIC, flags, sequence, len(chunk)) + encode_records(chunk))
+        return packets
+
+
+    # ========================================================================
+    # SERVER THREAD
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        while self.alive:
+            readers = [self._wake_r] + list(self._tcp_clients)
+            if self.tcp_socket is not None:
+                readers.append(self.tcp_socket)
+            if self.udp_socket is not None:
+                readers.append(self.udp_socket)
+            writers = [sock for sock, buffer in self._tcp_clients.items() if buffer]
+            timeout = MULTICAST_SNAPSHOT_INTERVAL if (self.multicast_address is not None) else UDP_SUBSCRIPTION_TIMEOUT
+            try:
+                readable, writable, failed = select.select(readers, writers, [], timeout)
+            except (OSError, ValueError):
+                readable, writable = [], []
+                self._drop_closed_clients()
+
+            for sock in readable:
+                if sock is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                elif sock is self.tcp_socket:
+                    self._accept()
+                elif sock is self.udp_socket:
+                    self._receive_subscriptions()
+                else:
+                    self._read_client(sock)
+
+            for sock in writable:
+                self._flush_client(sock)
+
+            self._send_outbox()
+            self._send_periodic()
+
+    def _accept(self):
+        try:
+            client, address = self.tcp_socket.accept()
+        except (BlockingIOError, OSError):
+            return
+        client.setblocking(False)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = bytearray()
+        for packet in self._packets(self._snapshot_records(), FLAG_SNAPSHOT):
+            buffer += FRAME_STRUCT.pack(len(packet)) + packet
+        self._tcp_clients[client] = buffer
+        self._flush_client(client)
+
+    def _read_client(self, sock):
+        # Clients don't send anything, this only detects disconnection
+        try:
+            data = sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop_client(sock)
+
+    def _flush_client(self, sock):
+        buffer = self._tcp_clients.get(sock)
+        if not buffer:
+            return
+        try:
+            sent = sock.send(buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop_client(sock)
+            return
+        del buffer[:sent]
+
+    def _drop_client(self, sock):
+        self._tcp_clients.pop(sock, None)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _drop_closed_clients(self):
+        for sock in list(self._tcp_clients):
+            if sock.fileno() < 0:
+                self._tcp_clients.pop(sock, None)
+
+    def _receive_subscriptions(self):
+        now = time.monotonic()
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(64)
+            except (BlockingIOError, OSError):
+                break
+            if data.startswith(MAGIC):
+                continue # Event packet, not a subscription
+            if not data.startswith(SNAPSHOT_REQUEST):
+                self._udp_clients[address] = now
+            self._udp_snapshots.append(address)
+
+    def _send_outbox(self):
+        with self._lock:
+            packets = list(self._outbox)
+            self._outbox.clear()
+
+        while self._udp_snapshots:
+            address = self._udp_snapshots.popleft()
+            for packet in self._packets(self._snapshot_records(), FLAG_SNAPSHOT):
+                self._send_datagram(self.udp_socket, packet, address)
+
+        for packet in packets:
+            frame = FRAME_STRUCT.pack(len(packet)) + packet
+            for sock, buffer in list(self._tcp_clients.items()):
+                if len(buffer) + len(frame) > MAX_CLIENT_BUFFER:
+                    self._drop_client(sock) # Too slow to keep up
+                    continue
+                buffer += frame
+                self._flush_client(sock)
+            for address in self._udp_clients:
+                self._send_datagram(self.udp_socket, packet, address)
+            if self.multicast_socket is not None:
+                self._send_datagram(self.multicast_socket, packet, self.multicast_address)
+
+    def _send_periodic(self):
+        now = time.monotonic()
+        expired = [address for address, last in self._udp_clients.items() if now - last > UDP_SUBSCRIPTION_TIMEOUT]
+        for address in expired:
+            del self._udp_clients[address]
+
+        if (self.multicast_socket is not None) and (now - self._last_multicast_snapshot >= MULTICAST_SNAPSHOT_INTERVAL):
+            self._last_multicast_snapshot = now
+            for packet in self._packets(self._snapshot_records(), FLAG_SNAPSHOT):
+                self._send_datagram(self.multicast_socket, packet, self.multicast_address)
+
+    def _send_datagram(self, sock, packet, address):
+        try:
+            sock.sendto(packet, address)
+        except (BlockingIOError, OSError):
+            pass # UDP is lossy anyway, clients catch up with snapshots
+
+
+# ============================================================================
+# CLIENT
+
+class EventClient:
+    """
+    Receives the events of an EventServer, over TCP (default) or UDP.
+    Keeps the latest state in axes, buttons and radios (dicts by number).
+
+    Usage:
+        client = EventClient('192.168.0.10')
+        for event in client.events():
+            ...
+    """
+
+    def __init__(self, host, port=DEFAULT_NET_PORT, udp=False, multicast_group=None, multicast_port=DEFAULT_MULTICAST_PORT):
+        # With multicast_group, packets are received from the group (and
+        # host may be None, to only wait for the periodic snapshots)
+        self.host = host
+        self.port = port
+        self.udp = udp or (multicast_group is not None)
+        self.multicast = multicast_group is not None
+        self.axes = {}
+        self.buttons = {}
+        self.radios = {}
+        self.sequence = None
+        self.lost_packets = 0
+        self._buffer = bytearray()
+        self._last_subscription = 0.0
+
+        if not self.udp:
+            self.sock = socket.create_connection((host, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if multicast_group is not None:
+                self.sock.bind(('', multicast_port))
+                membership = socket.inet_aton(multicast_group) + socket.inet_aton('0.0.0.0')
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            self._subscribe()
+
+    def close(self):
+        self.sock.close()
+
+    def _subscribe(self):
+        # Group members only ask for a snapshot, events come from the group
+        if self.host is not None:
+            self.sock.sendto(SNAPSHOT_REQUEST if self.multicast else SUBSCRIBE, (self.host, self.port))
+        self._last_subscription = time.monotonic()
+
+    def receive(self, timeout=None):
+        """Waits for the next packet and returns its records (also applied to
+        the state), [] on timeout, or None if the server closed the connection"""
+        if self.udp:
+            data = self._receive_datagram(timeout)
+            if data is None:
+                return []
+        else:
+            self.sock.settimeout(timeout)
+            try:
+                data = self._receive_frame()
+            except (socket.timeout, BlockingIOError):
+                return []
+            if data is None:
+                return None
+        decoded = decode_packet(data)
+        if decoded is None:
+            return []
+        sequence, flags, records = decoded
+
+        # Snapshots repeat the sequence of the last packet of events
+        if (self.sequence is not None) and not (flags & FLAG_SNAPSHOT):
+            gap = (sequence - self.sequence - 1) & 0xFFFFFFFF
+            if gap and (gap < 0x80000000):
+                self.lost_packets += gap
+                if self.udp:
+                    self._subscribe() # Ask for a snapshot to catch up
+        self.sequence = sequence
+
+        for record in records:
+            kind = record[0]
+            if kind == PACKET_AXIS:
+                self.axes[record[1]] = record[2]
+            elif kind == PACKET_BUTTON:
+                self.buttons[record[1]] = record[2]
+            elif kind == PACKET_RADIO:
+                self.radios[record[1]] = (record[2], record[3])
+        return records
+
+    def events(self):
+        """Iterator over received events, until the server closes the connection"""
+        while True:
+            records = self.receive()
+            if records is None:
+                return
+            for record in records:
+                yield record
+
+    def _receive_datagram(self, timeout):
+        # Waits no longer than the time left until the subscription is due
+        # at each step, so an idle client stays subscribed. None on timeout
+        deadline = None if (timeout is None) else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            wait = None
+            if (self.host is not None) and not self.multicast:
+                due = self._last_subscription + UDP_SUBSCRIPTION_TIMEOUT / 2.0
+                if now >= due:
+                    self._subscribe()
+                    due = now + UDP_SUBSCRIPTION_TIMEOUT / 2.0
+                wait = due - now
+            if deadline is not None:
+                left = max(0.0, deadline - now)
+                wait = left if (wait is None) else min(wait, left)
+            self.sock.settimeout(wait)
+            try:
+                return self.sock.recv(65536)
+            except (socket.timeout, BlockingIOError):
+                if (deadline is not None) and (time.monotonic() >= deadline):
+                    return None
+
+    def _receive_frame(self):
+        # Reads one size prefixed packet from the TCP stream
+        buffer = self._buffer
+        while True:
+            if len(buffer) >= FRAME_STRUCT.size:
+                size = FRAME_STRUCT.unpack_from(buffer, 0)[0]
+                if len(buffer) >= FRAME_STRUCT.size + size:
+                    packet = bytes(buffer[FRAME_STRUCT.size:FRAME_STRUCT.size + size])
+                    del buffer[:FRAME_STRUCT.size + size]
+                    return packet
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            buffer += data
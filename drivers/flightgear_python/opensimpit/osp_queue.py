@@ -0,0 +1,172 @@
+from collections import deque
+
+from osp_decode import PACKET_AXIS
+
+
+# ============================================================================
+# RECEIVE QUEUE
+#
+# Bounded receive queue between the serial reader thread (producer) and the
+# thread calling OpenSimPit.check() (consumer). There is exactly one producer
+# and one consumer, and every operation used below (deque append/popleft,
+# dict item assignment/popitem) is atomic in CPython, so no mutex is needed.
+
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_COALESCE    = 'coalesce'
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_COALESCE)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+
+class ReceiveQueue:
+    """
+    Fixed-capacity FIFO of decoded packets (see osp_decode), plus one latest-value-wins slot
+    per axis which is collected with take_axes().
+    When full, the overflow policy decides what happens to a new packet:
+      - drop-oldest: the oldest queued packet is discarded
+      - drop-newest: the new packet is discarded
+      - coalesce: axis values are moved to the axis slots, other packets
+        drop the oldest
+    If coalesce_axes is True, axis values always go to the axis slots and
+    only buttons, radios and messages are queued (keeping strict order).
+    If coalesce_backlog is set, axis values go to the axis slots while at
+    least that many packets are waiting, i.e. while the consumer is behind.
+
+    While an axis has a value in its slot, its new values go to the slot
+    too, so the slot is always newer than any queued packet of that axis,
+    and get() skips those queued packets. peek_axes() returns the slot
+    values without emptying the slots (e.g. to deliver the latest state
+    before the backlog), take_axes() empties them once the queue is drained.
+    Slots of axes already delivered in the same round can be kept for the
+    next one, so each axis is delivered at most once per round.
+    """
+
+    def __init__(self, size=DEFAULT_QUEUE_SIZE, policy=OVERFLOW_DROP_OLDEST, coalesce_axes=False, coalesce_backlog=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Invalid overflow policy: "+str(policy))
+        if size < 1:
+            raise ValueError("Queue size must be at least 1")
+
+        self.size = int(size)
+        self.policy = policy
+        self.coalesce_axes = coalesce_axes
+        self.coalesce_backlog = int(coalesce_backlog) if coalesce_backlog else self.size + 1
+        self._items = deque(maxlen=self.size)
+        self._axes = {} # axis_num -> latest value, only used when coalescing
+
+        # Only used by the consumer: slot values already returned by peek_axes()
+        self._peeked = {}
+
+        # Counters are only written by the producer thread
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._items) + (1 if self._axes else 0)
+
+    def put(self, item):
+        """Called from the reader thread to add a decoded packet"""
+        items = self._items
+        if item[0] == PACKET_AXIS:
+            if self.coalesce_axes:
+                self._axes[item[1]] = item[2]
+                return
+            # Consumer is behind (only the latest value matters), or the
+            # slot already holds a value, which must stay the newest one
+            if (len(items) >= self.coalesce_backlog) or (item[1] in self._axes):
+                self._axes[item[1]] = item[2]
+                self.coalesced += 1
+                return
+
+        if len(items) < self.size:
+            items.append(item)
+            return
+
+        policy = self.policy
+        if policy == OVERFLOW_DROP_NEWEST:
+            self.dropped_newest += 1
+            return
+
+        if (policy == OVERFLOW_COALESCE) and (item[0] == PACKET_AXIS):
+            self._axes[item[1]] = item[2]
+            self.coalesced += 1
+            return
+
+        # deque with maxlen discards the leftmost item by itself
+        self.dropped_oldest += 1
+        items.append(item)
+
+    def get(self):
+        """Returns the next queued packet, or None if the queue is empty"""
+        items = self._items
+        axes = self._axes
+        while True:
+            try:
+                item = items.popleft()
+            except IndexError:
+                return None
+            if (item[0] == PACKET_AXIS) and (item[1] in axes):
+                continue # Older than the value in the slot
+            return item
+
+    def pending(self):
+        """Returns how many packets are waiting, counting the axis slots as one"""
+        return len(self)
+
+    def clear(self):
+        self._items.clear()
+        self._axes.clear()
+        self._peeked.clear()
+
+    def get_counters(self):
+        return {
+            "dropped_oldest": self.dropped_oldest,
+            "dropped_newest": self.dropped_newest,
+            "coalesced": self.coalesced,
+        }
+
+    def reset_counters(self):
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.coalesced = 0
+
+    def peek_axes(self):
+        """Returns a dict with the slot values which changed since the last
+        peek_axes() or take_axes() (axis_num -> value), or None, leaving
+        the slots in place"""
+        if not self._axes:
+            return None
+        peeked = self._peeked
+        changed = {}
+        for axis_num, axis_value in self._axes.copy().items():
+            if peeked.get(axis_num) != axis_value:
+                changed[axis_num] = axis_value
+                peeked[axis_num] = axis_value
+        return changed or None
+
+    def take_axes(self, keep=None):
+        """Empties the axis slots. Returns a dict with the latest value of
+        every axis which changed since the last call (axis_num -> value,
+        leaving out what peek_axes() already returned), or None if none did.
+        The slots of the axes in keep (e.g. the ones just returned by
+        peek_axes()) are left in place, for the next peek_axes() to return
+        if they changed meanwhile.
+        Slots are only to be emptied with the queue drained, so the queue
+        holds no older packets of those axes"""
+        # pop() is atomic, so values written by the reader thread
+        # meanwhile are either taken now or left for the next call
+        axes = self._axes
+        peeked = self._peeked
+        taken = {}
+        for axis_num in list(axes):
+            if (keep is not None) and (axis_num in keep):
+                continue
+            axis_value = axes.pop(axis_num, None)
+            if axis_value is None:
+                continue
+            if peeked.pop(axis_num, None) != axis_value:
+                taken[axis_num] = axis_value
+        return taken or None
@@ -0,0 +1,352 @@
+import time
+from threading import Thread, Condition
+from collections import deque
+
+
+# ============================================================================
+# COMMAND WRITER
+#
+# Commands are queued by the caller and written by a separate thread, so
+# sending never blocks the game loop. Commands pending at the same time are
+# joined into a single write() call. With an OSPHub, the hub thread does
+# the writing too (see service()), so a board costs no thread of its own.
+#
+# The firmware answers every command with OK or ERROR, strictly in order.
+# With flow control enabled (default), those answers are used as credits:
+# only `window` commands are kept in flight, and more are sent as answers
+# arrive. The window adapts to the measured round-trip time (TCP Vegas
+# style): it grows while answers come back as fast as the quickest seen,
+# and shrinks when they get slower (commands queueing up in the board) or
+# get lost. Boards without native USB (Uno, Mega) also have a 64 bytes
+# receive buffer, so unanswered bytes are capped to that on those boards.
+#
+# The thread also runs one timed callback (call_at), used for outputs held
+# back by a rate limit, so they go out even if the program stops calling
+# check().
+#
+# Without flow control, the output is blindly paced with a minimum
+# interval per command instead, and commands are done once written.
+# Boards which never answer commands (the radio board, or firmware
+# ignoring commands it doesn't know) would make every command wait for its
+# timeout, so flow control falls back to blind pacing when the board
+# reports one of BLIND_BOARDS, or after MAX_LOST_ANSWERS commands in a row
+# got no answer. It is tried again when the board restarts.
+
+BAUDRATE = 115200
+BYTES_PER_SECOND = BAUDRATE / 10.0 # 8-N-1: 10 bits per byte
+SERIAL_BUFFER_SIZE = 64
+DEFAULT_COMMAND_INTERVAL = 0.002 # seconds per command, without flow control
+
+# Boards reading the serial port over native USB don't lose bytes when busy
+NATIVE_USB_BOARDS = ("Bluepill", "Arduino Leonardo")
+# Boards which don't answer commands with OK/ERROR
+BLIND_BOARDS = ("Radio",)
+MAX_LOST_ANSWERS = 3
+
+INITIAL_WINDOW = 2.0
+MIN_WINDOW = 1.0
+MAX_WINDOW = 32.0
+# Estimated commands queued inside the board (Vegas alpha/beta)
+QUEUED_LOW = 1.0
+QUEUED_HIGH = 3.0
+
+
+class CommandWriter:
+    """
+    Writer for one OSPConnection. Queued items are (bytes, future) pairs,
+    written in batches by a thread of its own (to
+    connection._write_commands()), or by the hub thread if a hub is given.
+    Written futures stay in flight until answered, expired or failed.
+    """
+
+    def __init__(self, connection, flow_control=True, command_interval=DEFAULT_COMMAND_INTERVAL, max_batch_bytes=SERIAL_BUFFER_SIZE, hub=None):
+        self.connection = connection
+        self.hub = hub
+        self.flow_control = flow_control
+        self.blind = False # Set when falling back to blind pacing
+        self.lost_answers = 0 # Commands in a row without answer
+        self.command_interval = command_interval
+        self.max_batch_bytes = max_batch_bytes
+        self.max_in_flight_bytes = SERIAL_BUFFER_SIZE # None for no limit
+        self.alive = False
+        self.thread = None
+        self._queue = deque()
+        self._in_flight = deque()
+        self._in_flight_bytes = 0
+        self._condition = Condition()
+        self._busy = False # True while a batch taken from the queue is being written
+        self._timer = None # (time, func) to be called from the thread, see call_at()
+        self._next_send = 0.0 # Pacing: earliest time for the next batch
+
+        self.window = INITIAL_WINDOW
+        self.rtt_min = None
+        self.rtt_last = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def start(self):
+        with self._condition:
+            if self.alive:
+                return
+            self.alive = True
+        if self.hub is not None:
+            self.hub.attach(self.connection)
+            return
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, flush_timeout=0.5):
+        """Stops writing, after trying to write what is still queued"""
+        if not self.alive:
+            return
+        self.flush(flush_timeout)
+        with self._condition:
+            self.alive = False
+            self._condition.notify_all()
+        if self.hub is not None:
+            self.hub.detach(self.connection)
+        else:
+            self.thread.join(2)
+
+    def put(self, data, future):
+        with self._condition:
+            self._queue.append((data, future))
+            self._notify()
+
+    def put_many(self, items):
+        """Queues several (data, future) pairs at once"""
+        with self._condition:
+            self._queue.extend(items)
+            self._notify()
+
+    def flush(self, timeout=None):
+        """Blocks until every queued command was written. Returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not (self._queue or self._busy) or not self.alive, timeout)
+
+    def discard(self):
+        """Removes every queued command, returning their futures"""
+        with self._condition:
+            futures = [item[1] for item in self._queue]
+            self._queue.clear()
+            self._condition.notify_all()
+        return futures
+
+    def call_at(self, when, func):
+        """Calls func() from the writer thread (or the hub thread) at time
+        when (time.monotonic() clock), replacing the call set before if it
+        was not made yet"""
+        with self._condition:
+            self._timer = (when, func)
+            self._notify()
+
+    def set_board(self, board):
+        """Adjusts the in-flight limits to the board model (from INIT or DUMP)"""
+        with self._condition:
+            self.max_in_flight_bytes = None if (board in NATIVE_USB_BOARDS) else SERIAL_BUFFER_SIZE
+            self.blind = board in BLIND_BOARDS
+            self._notify()
+
+    def reset_window(self):
+        with self._condition:
+            self.window = INITIAL_WINDOW
+            self.rtt_min = None
+            self.rtt_last = None
+            self.blind = False
+            self.lost_answers = 0
+            self._notify()
+
+    def _notify(self):
+        # Called with the condition held, when there may be work to do
+        self._condition.notify_all()
+        if self.hub is not None:
+            self.hub._wake()
+
+
+    # ========================================================================
+    # ANSWERS (called from the reader thread)
+
+    def answer(self, result):
+        """Resolves the oldest command in flight with the board answer"""
+        now = time.monotonic()
+        answered = None
+        with self._condition:
+            in_flight = self._in_flight
+            while in_flight:
+                future = in_flight.popleft()
+                self._in_flight_bytes -= future.size
+                if future.deadline > now:
+                    self.lost_answers = 0
+                    self._update_window(now - future.sent_time)
+                    answered = future
+                    break
+                # Commands past their timeout are considered lost (e.g. garbled
+                # on the line), otherwise one lost answer would shift all others
+                self._lost(future)
+            self._notify()
+        if answered is not None:
+            answered._resolve(result)
+
+    def fail_in_flight(self, exc):
+        """Fails every command in flight (e.g. board restarted or port closed)"""
+        with self._condition:
+            futures = list(self._in_flight)
+            self._in_flight.clear()
+            self._in_flight_bytes = 0
+            self._notify()
+        for future in futures:
+            future._resolve(exc = exc)
+
+    def _update_window(self, rtt):
+        # Called with the condition held
+        self.rtt_last = rtt
+        if (self.rtt_min is None) or (rtt < self.rtt_min):
+            self.rtt_min = rtt
+        if rtt <= 0:
+            return
+        queued = self.window * (1.0 - self.rtt_min / rtt)
+        if queued < QUEUED_LOW:
+            self.window = min(MAX_WINDOW, self.window + 1.0 / self.window)
+        elif queued > QUEUED_HIGH:
+            self.window = max(MIN_WINDOW, self.window - 1.0 / self.window)
+
+    def _lost(self, future):
+        # Called with the condition held
+        self.window = max(MIN_WINDOW, self.window / 2.0)
+        self.lost_answers += 1
+        if self.lost_answers >= MAX_LOST_ANSWERS:
+            self.blind = True
+        future._resolve(exc = TimeoutError("No answer to "+future.command))
+
+    def _expire(self, now):
+        # Called with the condition held. Frees the credits of lost commands
+        in_flight = self._in_flight
+        while in_flight and (in_flight[0].deadline <= now):
+            future = in_flight.popleft()
+            self._in_flight_bytes -= future.size
+            self._lost(future)
+
+
+    # ========================================================================
+    # WRITING (writer thread or hub thread)
+
+    def _can_send(self):
+        # Called with the condition held
+        if not self._queue:
+            return False
+        if self.blind or not self.flow_control:
+            return True
+        in_flight = len(self._in_flight)
+        if in_flight == 0:
+            return True
+        if in_flight + 1 > self.window:
+            return False
+        limit = self.max_in_flight_bytes
+        return (limit is None) or (self._in_flight_bytes + len(self._queue[0][0]) <= limit)
+
+    def _next_work_time(self):
+        # Called with the condition held. Returns when there is something
+        # to do (a time already passed means right away), or None if there
+        # is nothing to do until notified
+        times = []
+        if self._timer is not None:
+            times.append(self._timer[0])
+        if self._can_send():
+            times.append(self._next_send)
+        elif self._in_flight:
+            # Waiting for credit: answers notify, lost commands expire
+            times.append(self._in_flight[0].deadline)
+        return min(times) if times else None
+
+    def _take_work(self, now):
+        # Called with the condition held, when work is due. Returns
+        # (func, batch, futures, answered): the timed call, or a batch
+        if (self._timer is not None) and (self._timer[0] <= now):
+            func = self._timer[1]
+            self._timer = None
+            return func, None, None, False
+        answered = self.flow_control and not self.blind
+        batch, futures = self._take_batch(answered)
+        self._busy = True
+        return None, batch, futures, answered
+
+    def _take_batch(self, answered):
+        # Called with the condition held and credit for at least one command.
+        # Commands are only kept in flight if the board answers them
+        queue = self._queue
+        max_bytes = self.max_batch_bytes
+        batch = bytearray()
+        futures = []
+        now = time.monotonic()
+        self._expire(now)
+        while queue:
+            if futures and not self._can_send():
+                break
+            data = queue[0][0]
+            if futures and (len(batch) + len(data) > max_bytes):
+                break
+            data, future = queue.popleft()
+            batch += data
+            futures.append(future)
+            future.size = len(data)
+            future.sent_time = now
+            future.deadline = now + future.timeout
+            if answered:
+                self._in_flight.append(future)
+                self._in_flight_bytes += future.size
+        return batch, futures
+
+    def _written(self, batch, futures, answered):
+        # After a batch was written
+        if not answered:
+            # Nothing will answer them, they are done once written
+            for future in futures:
+                future._resolve(None)
+        # Pacing between batches: line rate, plus the blind interval per
+        # command when answers are not used as credits
+        delay = len(batch) / BYTES_PER_SECOND
+        if not answered:
+            delay = max(delay, len(futures) * self.command_interval)
+        with self._condition:
+            self._busy = False
+            self._next_send = time.monotonic() + delay
+            self._condition.notify_all()
+
+    def _do_work(self, func, batch, futures, answered, write):
+        if func is not None:
+            # Queues its commands, taken in the next round
+            func()
+            return
+        write(batch, futures)
+        self._written(batch, futures, answered)
+
+    def service(self, write):
+        """Does the work due now, from the hub thread. write(batch, futures)
+        writes a batch to the port. Returns when it is due again
+        (time.monotonic() clock), or None if nothing is due until woken up"""
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                self._expire(now)
+                when = self._next_work_time() if self.alive else None
+                if (when is None) or (when > now):
+                    return when
+                work = self._take_work(now)
+            self._do_work(*work, write)
+
+    def _run(self):
+        condition = self._condition
+        while True:
+            with condition:
+                while self.alive:
+                    now = time.monotonic()
+                    self._expire(now)
+                    when = self._next_work_time()
+                    if (when is not None) and (when <= now):
+                        break
+                    condition.wait(None if (when is None) else when - now)
+                if not self.alive:
+                    break
+                work = self._take_work(now)
+            self._do_work(*work, self.connection._write_commands)
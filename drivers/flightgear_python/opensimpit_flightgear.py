@@ -41,7 +41,7 @@
 
 
 FLIGHTGEAR_TELNET_PORT = 5403
-OPENSIMPIT_SERIAL_PORT = 'COM7'
+OPENSIMPIT_SERIAL_PORT = 'COM7' # None to find the board automatically
 
 UPDATE_FREQUENCY =     10 # Hz
 LCD_UPDATE_FREQUENCY = 1.0 # Hz
@@ -60,7 +60,16 @@ axis_options = {
     # 0: {
     #     "remap": [input start, input end, output start, output end],
     #     "deadzone": [start, end, output value],
+    #     "expo": amount from 0.0 (linear) to 1.0, less sensitive around the center,
+    #     "scurve": amount from 0.0 (linear) to 1.0, more sensitive around the center,
+    #     "points": [[input, output], [input, output], ...],
+    #     "filter": [deadband, hysteresis, min_change],
     # }
+    # The options are applied in the order above, and compiled once at start
+    # into a table with the output for every possible axis reading.
+    # "points" is a curve through the given points, straight between them.
+    # "filter" drops the jitter of the potentiometer before anything else,
+    # in raw counts (0-1023), see OpenSimPit.set_axis_filter()
     
     0: {
         "remap": [0.0, 1.0, 1.0, 0.0], # invert
@@ -146,69 +155,23 @@ radio_map = {
 
 
 import time
-from opensimpit import OpenSimPit
+from opensimpit import OpenSimPit, find_port, ROLE_MAIN
 from flightgearlib import FGConnection
 
 
 # To avoid spamming FlightGear with axes values, we buffer them and send only the last one
 axes_buffer = {}
 
-def remap_value(value, params):
-    i_min = params[0]
-    i_max = params[1]
-    o_min = params[2]
-    o_max = params[3]
-    
-    if (value <= i_min):
-        return o_min
-    if (value >= i_max):
-        return o_max
-    
-    i_range = (i_max - i_min)
-    o_range = (o_max - o_min)
-    ratio = (o_range / i_range)
-    
-    return (value - i_min) * ratio + o_min
-
-
-def apply_deadzone(value, params):
-    start = params[0]
-    end = params[1]
-    dead_value = params[2]
-    
-    if (value >= start) and (value <= end):
-        return dead_value
-    else:
-        return value
-    
-
-
 def on_axis_value(axis_number, value):
     global osp, fg, axis_map
-    if (type(axis_number) == str):
-        if not axis_number.isnumeric():
-            return
-        axis_number = int(axis_number)
-    
+    # value already went through the curve from axis_options
     if axis_number in axis_map:
-        if axis_number in axis_options:
-            opts = axis_options[axis_number]
-            if "remap" in opts:
-                value = remap_value(value, opts["remap"])
-            if "deadzone" in opts:
-                value = apply_deadzone(value, opts["deadzone"])
-        
         fg_var = axis_map[axis_number]
         axes_buffer[fg_var] = value
 
 
 def on_button_state(btn_number, value):
     global osp, fg, button_state_map
-    if (type(btn_number) == str):
-        if not btn_number.isnumeric():
-            return
-        btn_number = int(btn_number)
-    
     if btn_number in button_state_map:
         fg_var = button_state_map[btn_number]
         fg.set(fg_var, 'true' if value else 'false')
@@ -216,11 +179,6 @@ def on_button_state(btn_number, value):
 
 def on_button_press(btn_number):
     global osp, fg, button_press_map
-    if (type(btn_number) == str):
-        if not btn_number.isnumeric():
-            return
-        btn_number = int(btn_number)
-    
     if btn_number in button_press_map:
         btn_map = button_press_map[btn_number]
         if type(btn_map) == str:
@@ -241,11 +199,6 @@ def on_button_press(btn_number):
 
 def on_button_release(btn_number):
     global osp, fg, button_release_map
-    if (type(btn_number) == str):
-        if not btn_number.isnumeric():
-            return
-        btn_number = int(btn_number)
-    
     if btn_number in button_release_map:
         btn_map = button_release_map[btn_number]
         if type(btn_map) == str:
@@ -265,16 +218,12 @@ def on_button_release(btn_number):
 
 def on_radio_data(radio_number, active, standby):
     global osp, fg
-    if (type(radio_number) == str):
-        if not radio_number.isnumeric():
-            return
-        radio_number = int(radio_number)
-        if radio_number in radio_map:
-            freq_var_active  = radio_map[radio_number][0]
-            fg.set(freq_var_active, active)
-            
-            freq_var_standby = radio_map[radio_number][1]
-            fg.set(freq_var_standby, standby)
+    if radio_number in radio_map:
+        freq_var_active  = radio_map[radio_number][0]
+        fg.set(freq_var_active, active)
+        
+        freq_var_standby = radio_map[radio_number][1]
+        fg.set(freq_var_standby, standby)
     
 
 def send_axes():
@@ -299,25 +248,39 @@ def send_lcd16x2_setup():
             
 
 def send_lcd16x2_variables():
+    # Messages are written to the LCD shadow buffers, and a single flush
+    # sends only the characters which changed since last time
     for fg_var in lcd16x2_variable_messages:
         item = lcd16x2_variable_messages[fg_var]
         item_value = fg.get(fg_var)
         if item_value is not None:
             print(item_value)
-            osp.lcd16x2_message(item[0], item[1], item[2], item[3].format(value=item_value))
+            osp.lcd16x2_write(item[0], item[1], item[2], item[3].format(value=item_value))
+    osp.lcd16x2_flush()
 
 
 
 
 
 fg = FGConnection(FLIGHTGEAR_TELNET_PORT)
-osp = OpenSimPit(OPENSIMPIT_SERIAL_PORT) 
-
-osp.add_function_for_axis(on_axis_value)
-osp.add_function_for_button_state(on_button_state)
-osp.add_function_for_button_press(on_button_press)
-osp.add_function_for_button_release(on_button_release)
-osp.add_function_for_radio_data(on_radio_data)
+if OPENSIMPIT_SERIAL_PORT is None:
+    OPENSIMPIT_SERIAL_PORT = find_port(ROLE_MAIN)
+    print("OpenSimPit board found at "+str(OPENSIMPIT_SERIAL_PORT))
+osp = OpenSimPit(OPENSIMPIT_SERIAL_PORT, coalesce_axes=True)
+
+for axis_number in axis_options:
+    opts = axis_options[axis_number]
+    if "filter" in opts:
+        osp.set_axis_filter(axis_number, *opts["filter"])
+    osp.set_axis_curve(axis_number, opts)
+
+# Each handler is bound only to the inputs present in its map, so
+# unmapped inputs don't call anything
+osp.on_axis(axis_map.keys(), on_axis_value)
+osp.on_button_state(button_state_map.keys(), on_button_state)
+osp.on_button_press(button_press_map.keys(), on_button_press)
+osp.on_button_release(button_release_map.keys(), on_button_release)
+osp.on_radio_data(radio_map.keys(), on_radio_data)
 
 update_period = 1.0/UPDATE_FREQUENCY if (UPDATE_FREQUENCY > 0 and UPDATE_FREQUENCY < 50) else 0.02 # Max 50 Hz
 lcd_update_period = 1.0/LCD_UPDATE_FREQUENCY if (LCD_UPDATE_FREQUENCY > 0 and LCD_UPDATE_FREQUENCY < 10) else 0.1 # Max 10 Hz
@@ -333,11 +296,14 @@ while True:
             send_lcd16x2_variables()
         
     
-        osp.check()
+        # Each button sets FlightGear properties over telnet, so a burst
+        # is processed over several loops instead of stalling the axes
+        backlog = osp.check(max_time_ms = update_period * 500.0)
         send_axes()
         
         
-        time.sleep(update_period)
+        if backlog == 0:
+            time.sleep(update_period)
     except KeyboardInterrupt:
         break
 
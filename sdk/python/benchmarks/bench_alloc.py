@@ -0,0 +1,87 @@
+#       OpenSimPit python SDK - allocation benchmark
+#
+#       Measures the memory allocated per input event, with tracemalloc:
+#         - queued: bytes kept by each decoded packet waiting in the queue
+#           until check() is called
+#         - transient: peak of the temporary allocations made while decoding
+#           one line and dispatching it to a callback (garbage, freed right
+#           after the event)
+#
+#       Run from the sdk/python directory:
+#           python benchmarks/bench_alloc.py
+
+
+
+import os, sys, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+from osp_decode import decode_fast, decode_json, PACKET_AXIS, PACKET_BUTTON, PACKET_RADIO
+
+
+LINES = {
+    "axis":  b'{"axis":{"3":512}}\r',
+    "btn":   b'{"btn":{"17":1}}\r',
+    "rad1":  b'{"rad":{"2":[110.30,108.90]}}\r',
+}
+
+NUMBER = 20000
+
+
+def make_osp():
+    # Not connected to any board, only the dispatch path is used
+    osp = opensimpit.OpenSimPit(None, auto_reconnect=False, ready_timeout=0)
+    osp.add_function_for_axis(lambda num, value: None)
+    osp.add_function_for_button_state(lambda num, value: None)
+    osp.add_function_for_radio_data(lambda num, active, standby: None)
+    return osp
+
+
+def dispatch(osp, packet):
+    kind = packet[0]
+    if kind == PACKET_AXIS:
+        osp._process_axis(packet[1], packet[2])
+    elif kind == PACKET_BUTTON:
+        osp._process_button(packet[1], packet[2])
+    elif kind == PACKET_RADIO:
+        osp._process_radios(packet[1])
+
+
+def queued_bytes(decode, line):
+    packets = []
+    # Different line objects, as they would come from the serial port
+    lines = [bytes(bytearray(line)) for i in range(NUMBER)]
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for item in lines:
+        packets.append(decode(item))
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / NUMBER
+
+
+def transient_bytes(osp, decode, line):
+    lines = [bytes(bytearray(line)) for i in range(NUMBER)]
+    total = 0
+    tracemalloc.start()
+    for item in lines:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        packets = decode(item)
+        if type(packets) is tuple:
+            packets = (packets,)
+        for packet in packets:
+            dispatch(osp, packet)
+        packets = None
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / NUMBER
+
+
+if __name__ == '__main__':
+    osp = make_osp()
+    print("{:<6} {:>14} {:>14} {:>18}".format("line", "queued (B)", "transient (B)", "json transient (B)"))
+    for name, line in LINES.items():
+        assert decode_fast(line) is not None, name
+        print("{:<6} {:>14.0f} {:>14.0f} {:>18.0f}".format(
+            name, queued_bytes(decode_fast, line), transient_bytes(osp, decode_fast, line), transient_bytes(osp, decode_json, line)))
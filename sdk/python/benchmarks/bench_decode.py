@@ -0,0 +1,39 @@
+#       OpenSimPit python SDK - micro-benchmark
+#
+#       Compares the fast-path line decoder (osp_decode.decode_fast) against
+#       the json.loads path (osp_decode.decode_json) for the line shapes
+#       printed by the firmware during gameplay.
+#
+#       Run from the sdk/python directory:
+#           python benchmarks/bench_decode.py
+
+
+
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+from osp_decode import decode_fast, decode_json
+
+
+LINES = {
+    "axis":  b'{"axis":{"3":512}}\r',
+    "btn":   b'{"btn":{"17":1}}\r',
+    "rad":   b'{"rad":{"0":[118.00,121.50],"1":[122.80,119.10],"2":[110.30,108.90],"3":[113.00,116.20]}}\r',
+    "rad1":  b'{"rad":{"2":[110.30,108.90]}}\r',
+}
+
+NUMBER = 200000
+
+
+def bench(func, line):
+    return min(timeit.repeat(lambda: func(line), number=NUMBER, repeat=5)) / NUMBER * 1e9
+
+
+if __name__ == '__main__':
+    print("{:<6} {:>12} {:>12} {:>9}".format("line", "json (ns)", "fast (ns)", "speedup"))
+    for name, line in LINES.items():
+        assert decode_fast(line) is not None, name
+        slow = bench(decode_json, line)
+        fast = bench(decode_fast, line)
+        print("{:<6} {:>12.0f} {:>12.0f} {:>8.1f}x".format(name, slow, fast, slow / fast))
@@ -0,0 +1,63 @@
+#       OpenSimPit python SDK - import time benchmark
+#
+#       Measures the cold import of the opensimpit package in fresh
+#       interpreters, and checks that the modules only needed once a port is
+#       opened (or by optional features) are not imported with it.
+#       Exits with status 1 if the median import time is over the budget.
+#
+#       Run from the sdk/python directory:
+#           python benchmarks/bench_import.py [budget_ms]
+
+
+
+import os, sys, subprocess, statistics
+
+
+SDK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BUDGET_MS = 30.0
+RUNS = 15
+
+# Must not be imported by "import opensimpit"
+DEFERRED_MODULES = ('serial', 'asyncio', 'selectors', 'json', 'concurrent.futures', 'logging')
+
+CHILD = """
+import sys, time
+start = time.perf_counter()
+import opensimpit
+elapsed = time.perf_counter() - start
+loaded = [name for name in {modules!r} if name in sys.modules]
+print(repr((elapsed, loaded)))
+"""
+
+
+def import_once():
+    child = CHILD.format(modules=DEFERRED_MODULES)
+    # Measured with the compiled modules cached, like an installed package,
+    # even where the environment disables writing them
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.check_output([sys.executable, '-c', child], cwd=SDK_PATH, env=env)
+    return eval(output)
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+
+    import_once() # Writes the __pycache__ files, not counted
+    times = []
+    loaded = []
+    for run in range(RUNS):
+        elapsed, modules = import_once()
+        times.append(elapsed * 1000.0)
+        loaded = modules
+
+    median = statistics.median(times)
+    print("import opensimpit: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms (budget {:.1f} ms)".format(median, min(times), max(times), budget))
+    if loaded:
+        print("Imported too early: "+", ".join(loaded))
+
+    if loaded or (median > budget):
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
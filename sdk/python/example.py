@@ -34,6 +34,11 @@
 # e.g. 'COM4' or '/dev/ttyACM0'
 SERIAL_PORT = 'COM7'
 
+# Or find it automatically (all USB serial ports are probed at once, and
+# what was found is cached in ~/.opensimpit_ports.json for next time):
+# from opensimpit import find_port, ROLE_MAIN
+# SERIAL_PORT = find_port(ROLE_MAIN)
+
 
 
 import time
@@ -57,6 +62,29 @@ def on_button_release(btn_number):
 
 osp = OpenSimPit(SERIAL_PORT) 
 
+# Each OpenSimPit object owns its own serial port and callbacks, so more
+# boards (e.g. a standalone radio module) can be used in the same script
+# by creating one object per port:
+# radio = OpenSimPit('COM8')
+# On Linux/macOS, an OSPHub reads all those ports from one single thread:
+# hub = OSPHub()
+# osp = OpenSimPit(SERIAL_PORT, hub=hub)
+# radio = OpenSimPit('/dev/ttyUSB1', hub=hub)
+
+# Other local processes (overlays, loggers) can read the inputs without
+# owning the serial port, if the state is published to shared memory:
+# osp = OpenSimPit(SERIAL_PORT, shared_state='opensimpit')
+# and in the other process:
+# from opensimpit import SharedStateReader
+# state = SharedStateReader('opensimpit').read()
+
+# Or to other computers over the network (TCP, UDP and multicast):
+# from opensimpit import EventServer
+# osp.add_event_sink(EventServer())
+# and on the other computer:
+# from opensimpit import EventClient
+# for event in EventClient('192.168.0.10').events(): ...
+
 
 
 
@@ -71,6 +99,18 @@ osp.add_function_for_button_release(on_button_release)
 # given to it must have 2 arguments: button number and value, 
 # similar to add_function_for_axis()
 
+# Functions can also be bound to specific inputs only, so they are not
+# called for every other button or axis:
+# osp.on_button_press(5, on_button_press)
+# osp.on_axis(range(0, 3), my_axis_func)
+
+# Axis values can go through a response curve, computed once into a table
+# with the value for every possible reading (see osp_curve):
+# from opensimpit import AxisCurve
+# osp.set_axis_curve(0, AxisCurve().deadzone(0.48, 0.52, 0.5).expo(0.3))
+# and the jitter of cheap potentiometers can be filtered (in raw counts):
+# osp.set_axis_filter(0, deadband=4, hysteresis=3)
+
 
 
 
@@ -97,5 +137,10 @@ osp.run_forever()
 # Instead of letting the OpenSimPit class run forever as the main app,
 # you can instead call osp.check() periodically at your convenience,
 # along with whatever code you might have in your software.
+# osp.wait_for_events(timeout) blocks until there is something to check().
+# In a game loop, osp.check(max_events=50, max_time_ms=2) stops at the
+# budget and returns how many packets are still waiting for the next frame.
+# With OpenSimPit(SERIAL_PORT, coalesce_backlog=32), only the latest value of
+# each axis is kept while check() is behind, and it is delivered first.
 
 print("Done.")
@@ -0,0 +1,149 @@
+from bisect import bisect_right
+
+from osp_decode import AXIS_MAX, axis_value
+
+
+# ============================================================================
+# AXIS RESPONSE CURVES
+#
+# Raw axis readings are integers 0-1023, so any response curve can be
+# computed once for every possible reading, into a 1024-entry table. The
+# stages below (remap, deadzone, expo, S-curve, breakpoints) each transform
+# the whole table, in the order they are added, starting from the plain
+# 0.0-1.0 scale. Applying the compiled curve to a reading is then a single
+# index, however many stages it has: curve[raw].
+#
+# Values passed between stages are floats, normally 0.0-1.0 (remap may
+# produce any range, e.g. -1.0 to 1.0, and the next stages work on it).
+
+CURVE_SIZE = AXIS_MAX + 1
+
+
+class AxisCurve:
+    """
+    Response curve of one axis, as a lookup table by raw reading.
+    Stages return the curve itself, so they can be chained:
+        curve = AxisCurve().deadzone(0.48, 0.52, 0.5).expo(0.4)
+        value = curve[raw_value]
+    """
+    __slots__ = ('table',)
+
+    def __init__(self, table=None):
+        if table is None:
+            table = [axis_value(raw) for raw in range(CURVE_SIZE)]
+        if len(table) != CURVE_SIZE:
+            raise ValueError("Curve tables must have "+str(CURVE_SIZE)+" entries")
+        self.table = [float(value) for value in table]
+
+    def __getitem__(self, raw_value):
+        return self.table[raw_value]
+
+    def __len__(self):
+        return CURVE_SIZE
+
+    def apply(self, func):
+        """Adds a stage computed by func(value) -> value"""
+        self.table = [float(func(value)) for value in self.table]
+        return self
+
+    def remap(self, i_min, i_max, o_min, o_max):
+        """Maps i_min-i_max to o_min-o_max linearly, clamped outside.
+        o_min may be greater than o_max (inverted axis)"""
+        if i_max <= i_min:
+            raise ValueError("Remap input range must be increasing")
+        ratio = (o_max - o_min) / float(i_max - i_min)
+        def remap_value(value):
+            if value <= i_min:
+                return o_min
+            if value >= i_max:
+                return o_max
+            return (value - i_min) * ratio + o_min
+        return self.apply(remap_value)
+
+    def deadzone(self, start, end, dead_value):
+        """Values between start and end (inclusive) become dead_value"""
+        return self.apply(lambda value: dead_value if (start <= value <= end) else value)
+
+    def expo(self, amount, center=0.5, span=0.5):
+        """Less sensitive around center, more towards the ends, keeping the
+        ends in place. amount 0.0 is linear, 1.0 is fully cubic.
+        center and span are the middle and half range of the values"""
+        def expo_value(value):
+            x = _normalize(value, center, span)
+            return center + span * ((1.0 - amount) * x + amount * x * x * x)
+        return self._check_amount(amount).apply(expo_value)
+
+    def scurve(self, amount, center=0.5, span=0.5):
+        """More sensitive around center, less towards the ends (smoothstep),
+        keeping the ends in place. amount 0.0 is linear, 1.0 is the full S"""
+        def scurve_value(value):
+            x = _normalize(value, center, span)
+            # smoothstep on -1..1
+            s = 0.5 * x * (3.0 - x * x)
+            return center + span * ((1.0 - amount) * x + amount * s)
+        return self._check_amount(amount).apply(scurve_value)
+
+    def points(self, breakpoints):
+        """Piecewise linear curve through the (input, output) breakpoints,
+        constant before the first and after the last one"""
+        breakpoints = sorted((float(x), float(y)) for x, y in breakpoints)
+        if not breakpoints:
+            raise ValueError("At least one breakpoint is needed")
+        xs = [x for x, y in breakpoints]
+        def points_value(value):
+            i = bisect_right(xs, value)
+            if i == 0:
+                return breakpoints[0][1]
+            if i == len(breakpoints):
+                return breakpoints[-1][1]
+            x0, y0 = breakpoints[i - 1]
+            x1, y1 = breakpoints[i]
+            return y0 + (value - x0) * (y1 - y0) / (x1 - x0)
+        return self.apply(points_value)
+
+    def _check_amount(self, amount):
+        if not (0.0 <= amount <= 1.0):
+            raise ValueError("Curve amount must be in range 0.0-1.0")
+        return self
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Builds a curve from a dict of stages, applied in this order:
+            "remap": [input start, input end, output start, output end]
+            "deadzone": [start, end, output value]
+            "expo": amount (0.0-1.0), or [amount, center, span]
+            "scurve": amount (0.0-1.0), or [amount, center, span]
+            "points": [[input, output], ...]
+        Other keys are ignored
+        """
+        curve = cls()
+        if "remap" in options:
+            curve.remap(*options["remap"])
+        if "deadzone" in options:
+            curve.deadzone(*options["deadzone"])
+        if "expo" in options:
+            curve.expo(*_arguments(options["expo"]))
+        if "scurve" in options:
+            curve.scurve(*_arguments(options["scurve"]))
+        if "points" in options:
+            curve.points(options["points"])
+        return curve
+
+
+def curve_table(curve):
+    """Returns the lookup table of an AxisCurve, or of a dict of stages
+    (see AxisCurve.from_options)"""
+    if isinstance(curve, dict):
+        curve = AxisCurve.from_options(curve)
+    return curve.table
+
+
+def _normalize(value, center, span):
+    # -1.0 to 1.0 around center, clamped
+    x = (value - center) / span
+    return -1.0 if (x < -1.0) else (1.0 if (x > 1.0) else x)
+
+
+def _arguments(option):
+    return option if isinstance(option, (list, tuple)) else (option,)
@@ -0,0 +1,141 @@
+# ============================================================================
+# PACKET DECODING
+#
+# Lines received from the board are decoded into compact tuples:
+#   (PACKET_AXIS, axis_num, value)            value is an integer 0-1023
+#   (PACKET_BUTTON, btn_num, value)           value is an integer 0 or 1
+#   (PACKET_RADIO, ((radio_num, active, standby), ...))
+#   (PACKET_MESSAGE, data)                    data is the full JSON dict
+#
+# Input numbers are converted to integers here, once, although the board
+# sends them as JSON object keys (strings). Python keeps a single object for
+# each small integer, so the numbers cost no allocation per event.
+#
+# Almost all traffic during gameplay is one of the fixed shapes printed by
+# set_joystick_axis(), set_joystick_button() and serial_print_radio_report()
+# in the sketch, so those are parsed directly from the raw bytes. Anything
+# else (INIT, DUMP, msg, or unexpected formatting) falls back to json.loads.
+
+PACKET_AXIS    = 0
+PACKET_BUTTON  = 1
+PACKET_RADIO   = 2
+PACKET_MESSAGE = 3
+
+# Firmware limits (NUMBER_OF_BUILTIN_AXES and NUMBER_OF_JOYSTICK_BUTTONS in
+# the sketch) and the range of raw axis values
+NUMBER_OF_AXES = 6
+NUMBER_OF_BUTTONS = 32
+AXIS_MIN = 0
+AXIS_MAX = 1023
+
+_AXIS_PREFIX = b'{"axis":{"'
+_BTN_PREFIX  = b'{"btn":{"'
+_RAD_PREFIX  = b'{"rad":{"'
+_SUFFIX = b'}}'
+_WHITESPACE = b'\r\n\t '
+
+
+def decode_fast(line):
+    """Decodes a raw line (bytes or bytearray) in one of the known fixed
+    shapes. Returns the packet tuple, or None if the line must be decoded
+    by decode_json()"""
+    if line.startswith(_AXIS_PREFIX):
+        kind = PACKET_AXIS
+        start = 10
+    elif line.startswith(_BTN_PREFIX):
+        kind = PACKET_BUTTON
+        start = 9
+    elif line.startswith(_RAD_PREFIX):
+        return _decode_fast_radio(line)
+    else:
+        return None
+
+    # {"axis":{"3":512}}\r
+    # Only the number and value are copied out of the line
+    end = len(line)
+    while (end > 0) and (line[end-1] in _WHITESPACE):
+        end -= 1
+    if not line.endswith(_SUFFIX, 0, end):
+        return None
+    sep = line.find(b'":', start, end)
+    if sep < 0:
+        return None
+    num = line[start:sep]
+    value = line[sep+2:end-2]
+    if not (num.isdigit() and value.isdigit()):
+        return None # e.g. several inputs in one line
+    return (kind, int(num), int(value))
+
+
+def _decode_fast_radio(line):
+    # {"rad":{"0":[118.00,121.50],"1":[...],...}}\r
+    line = line.rstrip()
+    if not line.endswith(b']}}'):
+        return None
+    radios = []
+    try:
+        for entry in line[8:-3].split(b'],'):
+            # "0":[118.00,121.50
+            num, freqs = entry.split(b'":[')
+            active, standby = freqs.split(b',')
+            num = num[1:]
+            if not num.isdigit():
+                return None
+            radios.append((int(num), float(active), float(standby)))
+    except ValueError:
+        return None
+    return (PACKET_RADIO, tuple(radios))
+
+
+def axis_value(raw_value):
+    """Returns the float value (0.0-1.0) of a raw axis reading"""
+    return raw_value / float(AXIS_MAX)
+
+
+def curve_value(tables, axis_num, raw_value):
+    """Returns the value of a raw reading, from the table of the axis in
+    tables (dict by axis number, see osp_curve) or on the plain 0.0-1.0 scale"""
+    table = tables.get(axis_num)
+    if table is None:
+        return axis_value(raw_value)
+    if 0 <= raw_value <= AXIS_MAX:
+        return table[raw_value]
+    return table[0] if (raw_value < 0) else table[AXIS_MAX]
+
+
+def decode_json(line):
+    """Slow path: decodes a line with json.loads. Returns a list of packet
+    tuples (possibly empty), or None if the line is not a JSON object"""
+    import json # Deferred to the first message, json is slow to import
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return None
+
+    if not (type(data) is dict):
+        return None
+
+    packets = []
+    try:
+        if "axis" in data:
+            axes_data = data["axis"]
+            for axis_num in axes_data:
+                packets.append((PACKET_AXIS, int(axis_num), int(axes_data[axis_num])))
+
+        if "btn" in data:
+            buttons_data = data["btn"]
+            for btn_num in buttons_data:
+                packets.append((PACKET_BUTTON, int(btn_num), int(buttons_data[btn_num])))
+
+        if "rad" in data:
+            radio_data = data["rad"]
+            packets.append((PACKET_RADIO, tuple(
+                (int(radio_num), float(radio_data[radio_num][0]), float(radio_data[radio_num][1])) for radio_num in radio_data
+            )))
+    except (TypeError, ValueError, IndexError, AttributeError):
+        pass # Inputs not in the format sent by the firmware are ignored
+
+    if ("msg" in data) or ("ver" in data):
+        packets.append((PACKET_MESSAGE, data))
+
+    return packets
@@ -0,0 +1,103 @@
+from array import array
+
+from osp_decode import NUMBER_OF_AXES, AXIS_MIN, AXIS_MAX
+from osp_decode import PACKET_AXIS
+
+
+# ============================================================================
+# AXIS FILTER STAGE
+#
+# Cheap potentiometers jitter by a few ADC counts, and the firmware sends a
+# line for each change. The filter runs where lines are decoded (before
+# queueing), so noise never reaches the queue, the callbacks, the event
+# sinks or the simulator. Per axis, on raw values (0-1023):
+#   - deadband: readings within this many counts of either end snap to the
+#     end, so a lever at its stop reads exactly 0 or 1023
+#   - min_change: a new value must differ by at least this many counts from
+#     the last value delivered
+#   - hysteresis: when the movement reverses direction, it must be at least
+#     this many counts, so a value flickering between two readings is held
+#     while a lever moving one way is still followed count by count
+# Reaching an end is always delivered. State is kept in flat arrays
+# indexed by axis number, axes without filter are passed through.
+
+
+class AxisFilter:
+    """
+    Deadband, hysteresis and minimum change filter for all axes.
+    Configured with set(), applied by filter_packet() (from the thread
+    decoding the lines only).
+    """
+
+    def __init__(self):
+        self.enabled = array('b', [0] * NUMBER_OF_AXES)
+        self.deadband = array('H', [0] * NUMBER_OF_AXES)
+        self.hysteresis = array('H', [0] * NUMBER_OF_AXES)
+        self.min_change = array('H', [0] * NUMBER_OF_AXES)
+        self.last = array('h', [-1] * NUMBER_OF_AXES)     # -1: nothing delivered yet
+        self.direction = array('b', [0] * NUMBER_OF_AXES) # -1, 0 or 1
+        self.dropped = 0 # Readings dropped as noise
+
+    def set(self, axis_num, deadband=0, hysteresis=0, min_change=0):
+        """Sets the filter of one axis (or of all, if axis_num is None).
+        All zero disables it"""
+        if axis_num is None:
+            for num in range(NUMBER_OF_AXES):
+                self.set(num, deadband, hysteresis, min_change)
+            return
+        axis_num = int(axis_num)
+        if not (0 <= axis_num < NUMBER_OF_AXES):
+            raise ValueError("Axis number must be in range 0-"+str(NUMBER_OF_AXES - 1))
+        half_range = (AXIS_MAX - AXIS_MIN) // 2
+        for value in (deadband, hysteresis, min_change):
+            if not (0 <= value <= half_range):
+                raise ValueError("Axis filter values must be in range 0-"+str(half_range))
+        # Disabled while changing, the reader thread may be using it
+        self.enabled[axis_num] = 0
+        self.deadband[axis_num] = int(deadband)
+        self.hysteresis[axis_num] = int(hysteresis)
+        self.min_change[axis_num] = int(min_change)
+        self.last[axis_num] = -1
+        self.direction[axis_num] = 0
+        self.enabled[axis_num] = 1 if (deadband or hysteresis or min_change) else 0
+
+    def apply(self, axis_num, raw_value):
+        """Returns the value to deliver for a new reading, or None if the
+        reading is dropped as noise"""
+        if not (0 <= axis_num < NUMBER_OF_AXES) or not self.enabled[axis_num]:
+            return raw_value
+
+        deadband = self.deadband[axis_num]
+        if raw_value <= AXIS_MIN + deadband:
+            raw_value = AXIS_MIN
+        elif raw_value >= AXIS_MAX - deadband:
+            raw_value = AXIS_MAX
+
+        last = self.last[axis_num]
+        if last >= 0:
+            delta = raw_value - last
+            if delta == 0:
+                return None
+            direction = 1 if (delta > 0) else -1
+            if (raw_value != AXIS_MIN) and (raw_value != AXIS_MAX):
+                threshold = self.min_change[axis_num]
+                if direction != self.direction[axis_num]:
+                    threshold = max(threshold, self.hysteresis[axis_num])
+                if abs(delta) < threshold:
+                    return None
+            self.direction[axis_num] = direction
+
+        self.last[axis_num] = raw_value
+        return raw_value
+
+    def filter_packet(self, packet):
+        """Returns the axis packet to deliver (with the value snapped by
+        the deadband, if it was), or None if it is dropped"""
+        raw_value = packet[2]
+        value = self.apply(packet[1], raw_value)
+        if value is None:
+            self.dropped += 1
+            return None
+        if value != raw_value:
+            return (PACKET_AXIS, packet[1], value)
+        return packet
@@ -0,0 +1,51 @@
+import time
+from concurrent.futures import Future, InvalidStateError
+# Before python 3.11, Future.result() raises its own TimeoutError class
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+TIMEOUT_ERRORS = (TimeoutError, FutureTimeoutError)
+
+
+# ============================================================================
+# COMMAND RESPONSES
+
+class CommandFuture(Future):
+    """
+    Future returned by OSPConnection.send_command(). Resolves to True when the
+    board answers OK, or False when it answers ERROR. If no answer arrives
+    within the command timeout (counted from the moment the command is
+    written to the port), result() raises TimeoutError. Without flow
+    control, answers are not waited for: it resolves to None once written.
+    """
+
+    def __init__(self, command, timeout):
+        super(CommandFuture, self).__init__()
+        self.command = command
+        self.timeout = timeout
+        self.deadline = None # Set by the writer when the command is written
+        self.sent_time = None
+        self.size = 0
+
+    def result(self, timeout = None):
+        if timeout is not None:
+            return super(CommandFuture, self).result(timeout)
+        while True:
+            deadline = self.deadline
+            wait = self.timeout if (deadline is None) else max(0.0, deadline - time.monotonic())
+            try:
+                return super(CommandFuture, self).result(wait)
+            except TIMEOUT_ERRORS:
+                if (self.deadline is not None) and (time.monotonic() >= self.deadline):
+                    break
+        self._resolve(exc = TimeoutError("No answer to "+self.command))
+        return super(CommandFuture, self).result(0)
+
+    def _resolve(self, result = None, exc = None):
+        # The answer and the timeout may race, first one wins
+        try:
+            if exc is None:
+                self.set_result(result)
+            else:
+                self.set_exception(exc)
+        except InvalidStateError:
+            pass
@@ -0,0 +1,229 @@
+import os, selectors, threading, time
+from collections import deque
+
+from osp_serial import port_fileno
+
+
+# ============================================================================
+# I/O HUB
+#
+# Alternative to one reader thread per port: a single thread waits on the file
+# descriptors of all registered connections (epoll on Linux, kqueue on macOS)
+# and feeds whatever bytes are available to each connection's line framer.
+# Only available for serial ports exposing fileno() (posix). Connections on
+# other platforms keep using their own reader thread.
+#
+# The same thread writes the commands of every connection: it runs each
+# command writer (flow control, pacing, timed calls, see osp_writer) and
+# wakes up when the next one is due. Ports are written without blocking;
+# bytes the port didn't take yet are written when it is ready (EVENT_WRITE).
+
+READ_SIZE = 4096
+
+
+class OSPHub:
+    """
+    Single-threaded reader and writer for many OSPConnection objects.
+    Create one hub and pass it to every connection (or OpenSimPit) opened.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.alive = False
+        self.thread = None
+        self._lock = threading.Lock()
+        self._pending = deque() # (connection, register?, done event)
+        self._fds = {} # connection -> registered fd
+        self._writers = {} # connection -> write(batch, futures), see attach()
+        self._out = {} # connection -> bytes not taken by the port yet
+
+        # Self-pipe to interrupt select() when registrations change
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    @staticmethod
+    def supports(ser):
+        return port_fileno(ser) is not None
+
+    def register(self, connection):
+        """Starts reading the (already open) serial port of the connection"""
+        self._request(connection, True)
+
+    def unregister(self, connection):
+        """Stops reading the connection. Returns after the hub thread let it go,
+        so the port can be safely closed afterwards"""
+        self._request(connection, False)
+
+    def attach(self, connection):
+        """Starts writing the commands of the connection (its CommandWriter)"""
+        with self._lock:
+            self._writers[connection] = lambda batch, futures: self._write(connection, batch, futures)
+        self._start()
+        self._wake()
+
+    def detach(self, connection):
+        """Stops writing the commands of the connection"""
+        with self._lock:
+            self._writers.pop(connection, None)
+
+    def stop(self):
+        with self._lock:
+            if not self.alive:
+                return
+            self.alive = False
+        self._wake()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(2)
+
+    def _request(self, connection, register):
+        done = threading.Event()
+        self._pending.append((connection, register, done))
+        self._start()
+        if threading.current_thread() is self.thread:
+            self._apply_pending()
+        else:
+            self._wake()
+            done.wait(2)
+
+    def _start(self):
+        with self._lock:
+            if not self.alive:
+                self.alive = True
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass # Pipe is full, the hub is going to wake up anyway
+
+    def _apply_pending(self):
+        while self._pending:
+            connection, register, done = self._pending.popleft()
+            if register:
+                # A port which can't be registered is lost, without
+                # stopping the hub for the other connections
+                fd = port_fileno(connection.ser)
+                try:
+                    if fd is None:
+                        raise OSError("Serial port has no file descriptor")
+                    self.selector.register(fd, selectors.EVENT_READ, connection)
+                    self._fds[connection] = fd
+                except (OSError, ValueError) as e:
+                    connection._connection_lost(e)
+            else:
+                fd = self._fds.pop(connection, None)
+                if fd is not None:
+                    self.selector.unregister(fd)
+                self._out.pop(connection, None)
+            done.set()
+
+    def _drop(self, connection, fd, exc):
+        self.selector.unregister(fd)
+        self._fds.pop(connection, None)
+        self._out.pop(connection, None)
+        connection._connection_lost(exc)
+
+
+    # ========================================================================
+    # WRITING
+
+    def _service_writers(self):
+        # Runs the writers due, returns the seconds until the next one is
+        # due (None if none is)
+        with self._lock:
+            writers = list(self._writers.items())
+        next_time = None
+        for connection, write in writers:
+            when = connection.writer.service(write)
+            if (when is not None) and ((next_time is None) or (when < next_time)):
+                next_time = when
+        if next_time is None:
+            return None
+        return max(0.0, next_time - time.monotonic())
+
+    def _write(self, connection, batch, futures):
+        # Called from the writer of the connection, in the hub thread
+        fd = self._fds.get(connection)
+        if fd is None:
+            # Port closed or not read by the hub: written as usual
+            connection._write_commands(batch, futures)
+            return
+        out = self._out.get(connection)
+        if out:
+            out += batch # After the bytes still waiting for the port
+            return
+        with connection._write_lock:
+            try:
+                written = os.write(fd, batch)
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                for future in futures:
+                    future._resolve(exc = e)
+                return
+        if written < len(batch):
+            self._out[connection] = bytearray(batch[written:])
+            self.selector.modify(fd, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _on_writable(self, connection, fd):
+        out = self._out.get(connection)
+        if out:
+            with connection._write_lock:
+                try:
+                    written = os.write(fd, out)
+                except BlockingIOError:
+                    return
+                except OSError as e:
+                    self._drop(connection, fd, e)
+                    return
+            del out[:written]
+            if out:
+                return
+        self._out.pop(connection, None)
+        self.selector.modify(fd, selectors.EVENT_READ, connection)
+
+    def _run(self):
+        while self.alive:
+            timeout = self._service_writers()
+            for key, mask in self.selector.select(timeout):
+                connection = key.data
+                if connection is None:
+                    try:
+                        while os.read(self._wake_r, READ_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._apply_pending()
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    self._on_writable(connection, key.fd)
+                    if connection not in self._fds:
+                        continue # Dropped
+                if not (mask & selectors.EVENT_READ):
+                    continue
+
+                try:
+                    data = os.read(key.fd, READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    self._drop(connection, key.fd, e)
+                    continue
+
+                if not data:
+                    # Readiness without data means disconnected or multiple access on port
+                    self._drop(connection, key.fd, OSError('device reports readiness to read but returned no data'))
+                    continue
+
+                # make a separated try-except for called user code
+                try:
+                    connection.protocol.data_received(data)
+                except Exception as e:
+                    self._drop(connection, key.fd, e)
+
+        self._apply_pending()
@@ -0,0 +1,122 @@
+# ============================================================================
+# 16x2 LCD SHADOW BUFFER
+#
+# Keeps what the program wants on each character display, and what was
+# already sent to it. Flushing returns only the runs of characters that
+# changed, so text which is already on the glass is not sent again.
+# Two runs in the same row are merged into one command when resending the
+# characters between them costs fewer bytes than the header of another
+# "!LC=n,row,col," command. Runs are taken as shown when sent; if the
+# board rejects one (or it is lost), its cells are unknown again, so the
+# next flush sends them again.
+
+LCD16X2_ROWS = 2
+LCD16X2_COLS = 16
+
+
+def lcd16x2_command(lcd_num, row, col, text):
+    return "!LC="+str(int(lcd_num))+","+str(int(row))+","+str(int(col))+","+text
+
+def lcd16x2_backlight_command(lcd_num, active):
+    return "!LCB="+str(int(lcd_num))+","+('1' if active else '0')
+
+
+class LCD16x2Buffer:
+    """
+    Shadow framebuffer of one 16x2 LCD.
+    Cells are single characters, or None when unknown (for the shown
+    content) or not set by the program (for the wanted content).
+    """
+
+    def __init__(self, lcd_num):
+        self.lcd_num = lcd_num
+        self.wanted = [[None] * LCD16X2_COLS for row in range(LCD16X2_ROWS)]
+        self.shown = [[None] * LCD16X2_COLS for row in range(LCD16X2_ROWS)]
+        # Bytes of a "!LC=n,r,cc,...\n" command besides the text itself
+        self.overhead = len(lcd16x2_command(lcd_num, 0, 10, "")) + 1
+
+    def write(self, row, col, text):
+        """Updates the wanted content. Text beyond the last column is not visible, and is dropped"""
+        row = int(row)
+        col = int(col)
+        if (row < 0) or (row >= LCD16X2_ROWS) or (col < 0):
+            return
+        cells = self.wanted[row]
+        for char in text[:max(0, LCD16X2_COLS - col)]:
+            cells[col] = char
+            col += 1
+
+    def clear(self):
+        """To be called when the display is cleared (!LCC)"""
+        for row in range(LCD16X2_ROWS):
+            self.wanted[row] = [' '] * LCD16X2_COLS
+            self.shown[row] = [' '] * LCD16X2_COLS
+
+    def invalidate(self):
+        """Forgets what is on the glass (e.g. board restarted), so the next
+        flush sends all the wanted content again"""
+        for row in range(LCD16X2_ROWS):
+            self.shown[row] = [None] * LCD16X2_COLS
+
+    def is_dirty(self):
+        for row in range(LCD16X2_ROWS):
+            wanted = self.wanted[row]
+            shown = self.shown[row]
+            for col in range(LCD16X2_COLS):
+                if (wanted[col] is not None) and (wanted[col] != shown[col]):
+                    return True
+        return False
+
+    def flush(self):
+        """Returns the list of (row, col, text) runs to be sent to make the
+        display show the wanted content, and takes them as shown"""
+        runs = []
+        for row in range(LCD16X2_ROWS):
+            wanted = self.wanted[row]
+            shown = self.shown[row]
+            run_start = None # First column of the current run
+            run_end = None   # Last changed column of the current run
+            for col in range(LCD16X2_COLS):
+                char = wanted[col]
+                if (char is None) or (char == shown[col]):
+                    continue
+                if (run_start is not None) and not self._can_merge(row, run_end + 1, col):
+                    runs.append(self._take_run(row, run_start, run_end))
+                    run_start = None
+                if run_start is None:
+                    run_start = col
+                run_end = col
+            if run_start is not None:
+                runs.append(self._take_run(row, run_start, run_end))
+        return runs
+
+    def unsent(self, row, col, text):
+        """Forgets a run returned by flush() whose command failed, so the
+        next flush sends it again (cells changed since are kept)"""
+        shown = self.shown[row]
+        for char in text:
+            if shown[col] == char:
+                shown[col] = None
+            col += 1
+
+    def _can_merge(self, row, start, end):
+        # Columns start..end-1 are unchanged: resending them must be cheaper
+        # than a new command, and their content must be known
+        if end - start > self.overhead:
+            return False
+        wanted = self.wanted[row]
+        shown = self.shown[row]
+        for col in range(start, end):
+            if (wanted[col] is None) and (shown[col] is None):
+                return False
+        return True
+
+    def _take_run(self, row, start, end):
+        wanted = self.wanted[row]
+        shown = self.shown[row]
+        chars = []
+        for col in range(start, end + 1):
+            char = wanted[col] if (wanted[col] is not None) else shown[col]
+            chars.append(char)
+            shown[col] = char
+        return (row, start, ''.join(chars))
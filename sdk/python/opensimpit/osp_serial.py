@@ -1,142 +1,517 @@
-import os, sys, time, json
-from threading import Lock
+import os, time
+from threading import Thread, Lock, Event, current_thread
 
+# The bundled serial package is imported when a port is opened, so importing
+# the SDK stays cheap (serial.SerialException is a subclass of OSError)
 
-from serial import Serial
-from serial.serialutil import SerialException
-from serial.threaded import ReaderThread, LineReader
+from osp_queue import ReceiveQueue, DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST
+from osp_decode import decode_fast, decode_json, PACKET_AXIS, PACKET_MESSAGE
+from osp_writer import CommandWriter
+
+
+is_debug = False
+
+BAUDRATE = 115200
+
+DEFAULT_COMMAND_TIMEOUT = 2.0 # seconds
+
+# Boards restarting when the port is opened (Uno, Mega) take about 2 s to
+# run the bootloader and send INIT. Boards with native USB don't restart,
+# and answer the AT probe right away.
+DEFAULT_READY_TIMEOUT = 3.0 # seconds
+PROBE_INTERVAL = 0.1 # seconds
+
+# Lost ports are opened again after RECONNECT_MIN_DELAY, doubling the delay
+# after each failed attempt (a USB device takes a few hundred ms to show up)
+RECONNECT_MIN_DELAY = 0.05 # seconds
+RECONNECT_MAX_DELAY = 2.0 # seconds
+
+
+def port_fileno(ser):
+    """Returns the file descriptor of an open serial port, or None if it
+    can't be waited on with select (non-posix ports raise on fileno())"""
+    if os.name != 'posix':
+        return None
+    try:
+        return ser.fileno()
+    except (OSError, ValueError, AttributeError):
+        return None
 
 
 # ============================================================================
 # SERIAL THREAD
 
-received_list = []
-serial_mutex = Lock()
-received_response = False
-received_ok = False
-received_error = False
-received_init = False
-received_data = False
-received_dump = False
+def command_failed(future):
+    """Returns True if a command future resolved to ERROR, or failed (no
+    answer in time, port lost). Commands not answered (no flow control)
+    resolve to None, and are not failed"""
+    return (future.exception() is not None) or (future.result() is False)
 
-is_debug = False
 
-class OSPReader(LineReader):
+class OSPReaderThread(Thread):
+    """
+    Reads the serial port and feeds an OSPReader, like
+    serial.threaded.ReaderThread. Also stops on OSError (not only on
+    SerialException), which is what in_waiting raises when a USB serial
+    device is unplugged on posix.
+    """
+
+    def __init__(self, ser, protocol):
+        super(OSPReaderThread, self).__init__(daemon = True)
+        self.serial = ser
+        self.protocol = protocol
+        self.alive = True
+
+    def stop(self):
+        self.alive = False
+        if hasattr(self.serial, 'cancel_read'):
+            self.serial.cancel_read()
+        if current_thread() is not self:
+            self.join(2)
+
+    def run(self):
+        ser = self.serial
+        if not hasattr(ser, 'cancel_read'):
+            ser.timeout = 1
+        self.protocol.connection_made(self)
+        error = None
+        while self.alive and ser.is_open:
+            try:
+                # read all that is there or wait for one byte (blocking)
+                data = ser.read(ser.in_waiting or 1)
+            except OSError as e: # SerialException included
+                error = e
+                break
+            if data:
+                # make a separated try-except for called user code
+                try:
+                    self.protocol.data_received(data)
+                except Exception as e:
+                    error = e
+                    break
+        self.alive = False
+        self.protocol.connection_lost(error)
+
+
+class OSPReader:
+    """
+    Line framing protocol, fed by an OSPReaderThread or an OSPHub
+    """
     TERMINATOR = b'\n'
-    
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.transport = None
+        self.buffer = bytearray()
+
     def connection_made(self, transport):
         """Called when reader thread is started"""
-        super(OSPReader, self).connection_made(transport)
+        self.transport = transport
         if is_debug:
             print("Serial connection open")
 
-    def handle_line(self, packet):
-        """Process packet"""
-        decoded = _decode_packet(packet)
+    def data_received(self, data):
+        """Called by the reader with a chunk of bytes (possibly several lines)"""
+        buffer = self.buffer
+        buffer.extend(data)
+        if self.TERMINATOR in data:
+            packets = buffer.split(self.TERMINATOR)
+            buffer[:] = packets.pop()
+            for packet in packets:
+                self.handle_packet(packet)
+        # Wakes up whoever is blocked in wait_for_data(), once per chunk
+        data_available = self.connection.data_available
+        if not data_available.is_set():
+            data_available.set()
+
+    def handle_packet(self, packet):
+        """Process packet (raw bytes, before any text decoding)"""
+        connection = self.connection
+        connection.received_data = True
+
+        if is_debug:
+            print("> Received: "+packet.decode('utf-8', 'replace').rstrip())
+
+        # Fast path for axis, button and radio lines
+        decoded = decode_fast(packet)
+        if decoded is not None:
+            if decoded[0] == PACKET_AXIS:
+                # Axis noise is dropped before it is queued
+                decoded = connection.axis_filter.filter_packet(decoded)
+                if decoded is None:
+                    return
+            connection.received_queue.put(decoded)
+            return
+
+        decoded = connection._decode_packet(packet)
         if decoded is not None:
-            serial_mutex.acquire()
-            received_list.append(decoded)
-            serial_mutex.release()
+            for item in decoded:
+                if item[0] == PACKET_AXIS:
+                    item = connection.axis_filter.filter_packet(item)
+                    if item is None:
+                        continue
+                connection.received_queue.put(item)
 
     def connection_lost(self, exc):
+        self.transport = None
         if is_debug:
             print("Serial connection lost: "+str(exc))
-        
+        self.connection._on_connection_lost(exc)
 
 
-def _decode_packet(packet):
-    global serial_mutex
-    global received_data, received_response, received_ok, received_error, received_init, received_dump
 
-    try:
-        data = json.loads(packet)
-    except:
-        return None
-    
-    if not (type(data) is dict):
-        return None
-    
-    if is_debug:
-        print("> Received: "+packet)
-    
-    serial_mutex.acquire()
-    
-    received_data = True
-    if "msg" in data:
-        msg = data["msg"]
-        
-        if msg == "OK":
-            received_ok = True
-            received_response = True
+# ============================================================================
+# CONNECTION
+
+class OSPConnection:
+    """
+    One serial connection to an OpenSimPit board.
+    Owns the serial port, the reader thread, the received queue and the
+    response flags, so several boards can be used side by side.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST, coalesce_axes=False, hub=None, flow_control=True, auto_reconnect=True, coalesce_backlog=None):
+        # If an OSPHub is given, the port is read and written by the hub
+        # thread (shared with other connections) instead of a reader thread
+        # and a writer thread of its own.
+        # With flow_control, the OK/ERROR answers of the board limit how many
+        # commands are in flight (see osp_writer). Disable it for boards
+        # which don't answer commands.
+        # With auto_reconnect, a port which fails (e.g. USB cable glitch) or
+        # can't be opened is opened again in the background.
+        self.port = None
+        self.reset = True
+        self.ser = None
+        self.reader = None
+        self.hub = hub
+        self.protocol = None
+        self._write_lock = Lock()
+        # The writer also keeps the commands in flight, in sending order.
+        # The board processes commands sequentially, so each OK/ERROR
+        # answers the oldest one.
+        self.writer = CommandWriter(self, flow_control, hub=hub)
+
+        # Received packets are handed over to the main thread through a bounded queue.
+        # The reader thread is the only writer of the queue and of the flags below,
+        # so no mutex is taken per packet (single assignments are atomic).
+        self.received_queue = ReceiveQueue(queue_size, overflow_policy, coalesce_axes, coalesce_backlog)
+        self.data_available = Event()
+        # Drops axis jitter in the reader thread (see osp_filter)
+        from osp_filter import AxisFilter
+        self.axis_filter = AxisFilter()
         
-        elif msg == "ERROR":
-            received_error = True
-            received_response = True
-            
-        elif msg == "INIT":
-            received_init = True
-    
-    if "ver" in data:
-        received_dump = True
-    
-    serial_mutex.release()
-
-    return data
-
-
-def wait_for_flag_or_timeout(flag = 'ok'):
-    global serial_mutex
-    global received_data, received_response, received_ok, received_error, received_init, received_dump
-
-    for i in range(20):
-        serial_mutex.acquire()
-        flag_value = False
-        match flag:
-            case 'ok':
-                flag_value = received_ok
-            case 'error':
-                flag_value = received_error
-            case 'init':
-                flag_value = received_init
-            case 'dump':
-                flag_value = received_dump
-        serial_mutex.release()
+        self._flag_events = {flag: Event() for flag in ('ok', 'error', 'init', 'dump')}
+        self.received_response = False
+        self.received_ok = False
+        self.received_error = False
+        self.received_init = False
+        self.received_data = False
+        self.received_dump = False
+        self.board = None # Board model, from INIT or DUMP
+        self.dump = None # Last DUMP answer (dict)
+        self.config = None # Last DUMP answer, parsed (BoardConfig)
+
+        self.auto_reconnect = auto_reconnect
+        # Set when a lost port was opened again (and the board is ready).
+        # The owner clears it and sends its output state again.
+        self.reconnected = False
+        self._closing = Event()
+        self._reconnect_thread = None
+
+
+    def open(self, port, reset = True):
+        # With reset False, DTR and RTS are held low when opening, so boards
+        # with auto-reset circuits (Uno, Nano, Mega) don't restart (with
+        # most USB serial drivers)
+        self.port = port
+        self.reset = reset
+        self._closing.clear()
+        opened = self._open_port()
+        self.writer.start()
+        if (not opened) and self.auto_reconnect:
+            self._start_reconnect()
+        return opened
+
+    def close(self):
+        self._closing.set()
+        thread = self._reconnect_thread
+        if (thread is not None) and (thread is not current_thread()):
+            thread.join(2)
+
+        self.writer.stop()
+        for future in self.writer.discard():
+            future._resolve(exc = ConnectionError("Serial port closed"))
+        self._close_port()
+
+    def _open_port(self):
+        from serial import Serial
+
+        ser = Serial()
+        ser.baudrate = BAUDRATE
+        ser.port = self.port
+        if not self.reset:
+            ser.dtr = False
+            ser.rts = False
+        with self._write_lock:
+            self.ser = ser
+        self.clear_flag('init')
+        try:
+            ser.open()
+        except OSError:
+            return False
+
+        if (self.hub is not None) and self.hub.supports(ser):
+            self.protocol = OSPReader(self)
+            self.protocol.connection_made(self)
+            self.hub.register(self)
+        else:
+            # A thread can only be started once, so each opening has its own
+            self.reader = OSPReaderThread(ser, OSPReader(self))
+            self.reader.start()
+        return ser.is_open
+
+    def _close_port(self):
+        if self.reader is not None:
+            with self._write_lock:
+                self.reader.stop()
+                self.ser.close()
+            self.reader = None
         
-        if flag_value:
+        elif self.protocol is not None:
+            self.hub.unregister(self)
+            with self._write_lock:
+                self.ser.close()
+            self._connection_lost(None)
+
+    def _on_connection_lost(self, exc):
+        # Called from the reader thread (or the hub thread) when reading stops
+        self._fail_pending(exc if exc is not None else ConnectionError("Serial port closed"))
+        self.data_available.set()
+        if (exc is None) or self._closing.is_set() or not self.auto_reconnect:
+            return
+
+        # Commands queued meanwhile are stale: once reconnected, the owner
+        # sends its whole output state again
+        for future in self.writer.discard():
+            future._resolve(exc = exc)
+        with self._write_lock:
+            self.ser.close()
+        self.reader = None
+        self.protocol = None
+        self._start_reconnect()
+
+    def _start_reconnect(self):
+        thread = self._reconnect_thread
+        if (thread is not None) and thread.is_alive():
+            return
+        self._reconnect_thread = Thread(target=self._reconnect, daemon=True)
+        self._reconnect_thread.start()
+
+    def _reconnect(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._closing.wait(delay):
+            delay = min(delay * 2.0, RECONNECT_MAX_DELAY)
+            if not self._open_port():
+                continue
+            if self._closing.is_set():
+                self._close_port()
+                return
+            if is_debug:
+                print("Serial connection reopened")
+            self.writer.reset_window()
+            self.wait_ready()
+            if not self.is_open():
+                continue # Lost again while waiting
+            self.reconnected = True
+            self.data_available.set()
+            return
+
+    def wait_ready(self, timeout = DEFAULT_READY_TIMEOUT):
+        """Blocks until the board is ready to take commands, that is, it sent
+        INIT (it restarted when the port was opened) or answered an AT probe.
+        Returns False if neither happened within the timeout"""
+        from osp_future import TIMEOUT_ERRORS
+        deadline = time.monotonic() + timeout
+        init = self._flag_events['init']
+        while self.is_open() and not (init.is_set() or self._closing.is_set()):
+            probe = self.send_command("AT", PROBE_INTERVAL)
+            try:
+                if probe.result():
+                    return True
+            except ConnectionResetError:
+                return True # INIT arrived while the probe was in flight
+            except TIMEOUT_ERRORS:
+                pass # Still booting (the bootloader ignores the probe)
+            except OSError:
+                return False
+            if time.monotonic() >= deadline:
+                return init.is_set()
+        return init.is_set()
+
+    def is_open(self):
+        if self.reader is not None:
+            return self.reader.alive
+        return self.protocol is not None
+
+    def write(self, data):
+        """Thread safe writing of raw bytes"""
+        with self._write_lock:
+            return self.ser.write(data)
+
+    def _connection_lost(self, exc):
+        # Called by the hub (the reader thread notifies its protocol by itself)
+        protocol = self.protocol
+        self.protocol = None
+        if protocol is not None:
+            protocol.connection_lost(exc)
+
+
+    def send_command(self, data, timeout = DEFAULT_COMMAND_TIMEOUT):
+        """Sends a command to the board. Returns a CommandFuture resolving
+        to True (OK) or False (ERROR) when the board answers (or to None
+        once written, without flow control)"""
+        if is_debug:
+            print("> Sending: "+data)
+        # concurrent.futures (and logging with it) is only imported once used
+        from osp_future import CommandFuture
+        future = CommandFuture(data, timeout)
+        # Written later by the writer thread, so this returns immediately
+        self.writer.put((data+'\n').encode('utf-8'), future)
+        return future
+
+    def send_commands(self, commands, timeout = DEFAULT_COMMAND_TIMEOUT):
+        """Sends several commands in one burst (queued at once, so they are
+        written in as few batches as the flow control allows).
+        Returns the list of CommandFuture"""
+        from osp_future import CommandFuture
+        items = []
+        for data in commands:
+            if is_debug:
+                print("> Sending: "+data)
+            items.append(((data+'\n').encode('utf-8'), CommandFuture(data, timeout)))
+        self.writer.put_many(items)
+        return [item[1] for item in items]
+
+    def flush(self, timeout = None):
+        """Blocks until all commands sent were written to the port"""
+        return self.writer.flush(timeout)
+
+    def call_at(self, when, func):
+        """Calls func() from the writer thread at time when (time.monotonic()
+        clock), e.g. to send outputs held back by a rate limit"""
+        self.writer.call_at(when, func)
+
+    def _write_commands(self, data, futures):
+        # Called from the writer thread with a batch of joined commands
+        with self._write_lock:
+            try:
+                self.ser.write(data)
+            except OSError as e:
+                for future in futures:
+                    future._resolve(exc = e)
+
+    def _fail_pending(self, exc):
+        self.writer.fail_in_flight(exc)
+
+
+    def check_packet(self):
+        """Returns the next item from the received queue. If there are no items, returns None"""
+        return self.received_queue.get()
+
+    def wait_for_data(self, timeout = None):
+        """Blocks until there is something in the received queue (or the
+        connection is lost), or the timeout in seconds expires.
+        Returns True if the queue is not empty"""
+        # Clear before checking, so data arriving in between is not missed
+        self.data_available.clear()
+        if len(self.received_queue) > 0:
             return True
-        
-        time.sleep(0.1)
-    return False
+        self.data_available.wait(timeout)
+        return len(self.received_queue) > 0
 
-def check_packet():
-    """Returns the next item from the received queue. If there are no items, returns None"""
-    serial_mutex.acquire()
-    item = received_list.pop(0) if len(received_list) > 0 else None
-    serial_mutex.release()
-    return item
+    def pending(self):
+        """Returns how many received packets are waiting to be checked"""
+        return self.received_queue.pending()
 
+    def check_axes(self, keep=None):
+        """Returns a dict with the latest value of each coalesced axis, or
+        None, and empties the axis slots except the ones of the axes in keep.
+        Only valid with the queue drained"""
+        return self.received_queue.take_axes(keep)
 
-ser = Serial()
-ser.baudrate = 115200
-reader = ReaderThread(ser, OSPReader)
+    def peek_axes(self):
+        """Returns a dict with the coalesced axis values not returned yet,
+        or None, leaving them in the axis slots"""
+        return self.received_queue.peek_axes()
 
-def open_port(_port):
-    global ser
-    
-    ser.port = _port
-    try:
-        ser.open()
-        reader.start()
-        return ser.is_open
-    except SerialException:
-        return False
-
-def close_port():
-    reader.close()
-
-def send_command(data):
-    if is_debug:
-        print("> Sending: "+data)
-    reader.write((data+'\n').encode('utf-8'))
-    time.sleep(0.002) # To avoid overloading the serial port in case of too many calls
-    
+    def set_queue_options(self, size = DEFAULT_QUEUE_SIZE, policy = OVERFLOW_DROP_OLDEST, coalesce_axes = False, coalesce_backlog = None):
+        """Replaces the received queue. Packets still pending are discarded.
+        policy is one of 'drop-oldest', 'drop-newest' or 'coalesce'.
+        If coalesce_axes is True, only the latest value of each axis is kept.
+        If coalesce_backlog is set, the same happens while at least that
+        many packets are waiting."""
+        self.received_queue = ReceiveQueue(size, policy, coalesce_axes, coalesce_backlog)
+
+    def get_drop_counters(self):
+        """Returns a dict with how many packets were dropped or coalesced due to queue overflow"""
+        return self.received_queue.get_counters()
+
+
+    def wait_for_flag_or_timeout(self, flag = 'ok', timeout = 2.0):
+        """Waits until the board sends a message of the given kind ('ok',
+        'error', 'init' or 'dump') after the last clear_flag() for it.
+        Prefer the future returned by send_command() to wait for answers."""
+        return self._flag_events[flag].wait(timeout)
+
+    def clear_flag(self, flag):
+        self._flag_events[flag].clear()
+
+
+    def _decode_packet(self, packet):
+        # Called from the reader thread for lines not taken by the fast path
+        decoded = decode_json(packet)
+        if decoded is None:
+            return None
+
+        for item in decoded:
+            if item[0] != PACKET_MESSAGE:
+                continue
+            data = item[1]
+
+            if "msg" in data:
+                msg = data["msg"]
+
+                if (msg == "OK") or (msg == "AT OK"):
+                    self.received_ok = True
+                    self.received_response = True
+                    self._flag_events['ok'].set()
+                    self.writer.answer(True)
+
+                elif msg == "ERROR":
+                    self.received_error = True
+                    self.received_response = True
+                    self._flag_events['error'].set()
+                    self.writer.answer(False)
+
+                elif msg == "INIT":
+                    self.received_init = True
+                    self._flag_events['init'].set()
+                    # Board has restarted, commands in flight are lost
+                    self._fail_pending(ConnectionResetError("Board restarted"))
+                    self.writer.reset_window()
+
+            if "board" in data:
+                self.board = data["board"]
+                self.writer.set_board(self.board)
+
+            if "ver" in data:
+                self.dump = data
+                from osp_config import BoardConfig
+                try:
+                    self.config = BoardConfig.from_dump(data)
+                except ValueError:
+                    self.config = None
+                self.received_dump = True
+                self._flag_events['dump'].set()
+
+        return decoded
@@ -0,0 +1,99 @@
+import time
+from array import array
+
+
+# ============================================================================
+# SERVO OUTPUT STAGE
+#
+# Servo positions are not sent right away: only the newest target of each
+# servo is kept, targets equal to what was already sent are dropped, and
+# each servo gets at most one "!S=" command per 1/max_rate seconds. A
+# target set while its servo is still rate limited is sent by a later
+# flush, so the last value always gets through. If the board rejects a
+# command (or it is lost), what was sent is unknown again, so setting the
+# same target later is not dropped as unchanged.
+
+NUMBER_OF_SERVOS = 256 # 16 PCA9685 boards with 16 outputs each
+DEFAULT_SERVO_MAX_RATE = 20.0 # commands per second per servo
+
+
+def servo_command(servo_num, percentage):
+    return "!S="+str(int(servo_num))+","+str(int(percentage))
+
+
+class ServoStage:
+    """
+    Latest-wins output stage for all servos, with per-servo rate caps.
+    State is kept in flat arrays indexed by servo number.
+    """
+
+    def __init__(self, max_rate=DEFAULT_SERVO_MAX_RATE):
+        interval = (1.0 / max_rate) if max_rate else 0.0
+        self.target = array('b', [-1] * NUMBER_OF_SERVOS)   # -1: never set
+        self.sent = array('b', [-1] * NUMBER_OF_SERVOS)     # -1: unknown
+        self.next_time = array('d', [0.0] * NUMBER_OF_SERVOS)
+        self.min_interval = array('d', [interval] * NUMBER_OF_SERVOS)
+        self._dirty = set() # Servos where target != sent
+
+    def set_max_rate(self, servo_num, max_rate):
+        """Sets the maximum commands per second of one servo (None or 0 for no limit)"""
+        self.min_interval[self._check_index(servo_num)] = (1.0 / max_rate) if max_rate else 0.0
+
+    def set(self, servo_num, percentage):
+        servo_num = self._check_index(servo_num)
+        percentage = min(100, max(0, int(percentage)))
+        self.target[servo_num] = percentage
+        if percentage != self.sent[servo_num]:
+            self._dirty.add(servo_num)
+        else:
+            self._dirty.discard(servo_num)
+
+    def invalidate(self):
+        """Forgets what was sent (e.g. board restarted), so every servo
+        with a target is sent again by the next flush, without rate limit"""
+        for servo_num in range(NUMBER_OF_SERVOS):
+            self.sent[servo_num] = -1
+            self.next_time[servo_num] = 0.0
+            if self.target[servo_num] >= 0:
+                self._dirty.add(servo_num)
+
+    def unsent(self, servo_num, percentage):
+        """Notes that the command setting percentage failed (unless a
+        different position was sent since). Can be called from any thread"""
+        if self.sent[servo_num] == percentage:
+            self.sent[servo_num] = -1
+
+    def flush(self, now=None):
+        """Returns the list of (servo_num, percentage) due to be sent now,
+        and takes them as sent"""
+        if not self._dirty:
+            return []
+        if now is None:
+            now = time.monotonic()
+        due = []
+        next_time = self.next_time
+        for servo_num in self._dirty:
+            if next_time[servo_num] <= now:
+                due.append(servo_num)
+
+        commands = []
+        for servo_num in sorted(due):
+            percentage = self.target[servo_num]
+            self.sent[servo_num] = percentage
+            next_time[servo_num] = now + self.min_interval[servo_num]
+            self._dirty.discard(servo_num)
+            commands.append((servo_num, percentage))
+        return commands
+
+    def next_due(self):
+        """Returns when the next pending servo can be sent (time.monotonic()
+        clock), or None if nothing is pending"""
+        if not self._dirty:
+            return None
+        return min(self.next_time[servo_num] for servo_num in self._dirty)
+
+    def _check_index(self, servo_num):
+        servo_num = int(servo_num)
+        if (servo_num < 0) or (servo_num >= NUMBER_OF_SERVOS):
+            raise ValueError("Servo number must be in range 0-"+str(NUMBER_OF_SERVOS-1))
+        return servo_num
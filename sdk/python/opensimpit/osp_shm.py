@@ -0,0 +1,189 @@
+import struct, time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from osp_decode import NUMBER_OF_AXES, NUMBER_OF_BUTTONS, AXIS_MAX
+
+
+# ============================================================================
+# SHARED STATE BLOCK
+#
+# The process owning the serial port can publish the current input state
+# (axes, buttons and radio frequencies) into a small named shared memory
+# block, so other local processes read it directly from memory, with no
+# syscalls and no serialization.
+#
+# Consistency uses a sequence counter (seqlock): the writer makes it odd
+# before changing the block and even again afterwards. Readers copy the
+# block and accept the copy only if the counter was even and unchanged
+# around it, retrying otherwise. There is a single writer per block.
+#
+# Layout (little endian, 108 bytes):
+#     0   4s    magic "OSP2"
+#     4   I     block size
+#     8   Q     sequence (odd while being written)
+#     16  d     time of the last update (time.time())
+#     24  6H    raw axis values (0-1023), one per firmware axis
+#     36  Q     buttons bitmap (bit n = button n pressed, 32 buttons used)
+#     44  8d    radios: active, standby for COM1, COM2, NAV1, NAV2
+
+MAGIC = b'OSP2' # OSP1 blocks had 8 axes
+NUMBER_OF_RADIOS = 4
+
+STATE_STRUCT = struct.Struct('<4sIQd' + str(NUMBER_OF_AXES) + 'HQ' + str(2 * NUMBER_OF_RADIOS) + 'd')
+SEQUENCE_STRUCT = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+PAYLOAD_STRUCT = struct.Struct('<d' + str(NUMBER_OF_AXES) + 'HQ' + str(2 * NUMBER_OF_RADIOS) + 'd')
+PAYLOAD_OFFSET = 16
+BLOCK_SIZE = STATE_STRUCT.size
+
+DEFAULT_BLOCK_NAME = 'opensimpit'
+
+
+# Snapshot returned by SharedStateReader.read()
+SharedState = namedtuple('SharedState', ('sequence', 'timestamp', 'axes', 'buttons', 'radios'))
+
+
+def _attach(name):
+    # Processes only attaching to the block must not unlink it when they
+    # exit (the posix resource tracker does so before python 3.13)
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+
+class SharedStateWriter:
+    """
+    Publishes the input state of one board. set_*() only change a local
+    copy, publish() writes it into the shared block at once.
+    """
+
+    def __init__(self, name=DEFAULT_BLOCK_NAME):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=BLOCK_SIZE)
+            self.owner = True
+        except FileExistsError:
+            # Left behind by a previous run
+            self.shm = _attach(name)
+            self.owner = False
+        if self.shm.size < BLOCK_SIZE:
+            self.shm.close()
+            raise ValueError("Shared memory block "+repr(name)+" is too small")
+        self.buffer = self.shm.buf
+
+        self.axes = [0] * NUMBER_OF_AXES
+        self.buttons = 0
+        self.radios = [0.0] * (2 * NUMBER_OF_RADIOS)
+        self.sequence = 0
+        self.dirty = True
+
+        STATE_STRUCT.pack_into(self.buffer, 0, MAGIC, BLOCK_SIZE, 0, 0.0, *(self.axes + [0] + self.radios))
+        self.publish()
+
+    def set_axis(self, axis_num, raw_value):
+        if 0 <= axis_num < NUMBER_OF_AXES:
+            self.axes[axis_num] = raw_value
+            self.dirty = True
+
+    def set_button(self, btn_num, pressed):
+        if 0 <= btn_num < NUMBER_OF_BUTTONS:
+            if pressed:
+                self.buttons |= (1 << btn_num)
+            else:
+                self.buttons &= ~(1 << btn_num)
+            self.dirty = True
+
+    def set_radio(self, radio_num, active, standby):
+        if 0 <= radio_num < NUMBER_OF_RADIOS:
+            self.radios[2 * radio_num] = active
+            self.radios[2 * radio_num + 1] = standby
+            self.dirty = True
+
+    def publish(self):
+        """Writes the local state into the block, if it changed"""
+        if not self.dirty:
+            return
+        buffer = self.buffer
+        sequence = self.sequence + 1
+        SEQUENCE_STRUCT.pack_into(buffer, SEQUENCE_OFFSET, sequence) # odd: being written
+        PAYLOAD_STRUCT.pack_into(buffer, PAYLOAD_OFFSET, time.time(), *self.axes, self.buttons, *self.radios)
+        self.sequence = sequence + 1
+        SEQUENCE_STRUCT.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        self.dirty = False
+
+    def close(self):
+        """Releases the block. The process which created it also removes it"""
+        if self.shm is None:
+            return
+        self.buffer.release()
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = None
+
+
+class SharedStateReader:
+    """
+    Reads the state published by another process (see SharedStateWriter).
+
+    Usage:
+        state = SharedStateReader('opensimpit')
+        snapshot = state.read()
+        snapshot.axes[0], snapshot.buttons & (1 << 5), snapshot.radios[0]
+    """
+
+    def __init__(self, name=DEFAULT_BLOCK_NAME):
+        self.name = name
+        self.shm = _attach(name)
+        self.buffer = self.shm.buf
+        if bytes(self.buffer[0:4]) != MAGIC:
+            self.close()
+            raise ValueError("Shared memory block "+repr(name)+" is not an OpenSimPit state block")
+
+    def sequence(self):
+        """Returns the sequence counter, which changes on every update"""
+        return SEQUENCE_STRUCT.unpack_from(self.buffer, SEQUENCE_OFFSET)[0]
+
+    def read(self):
+        """Returns a consistent SharedState snapshot. axes are raw values
+        (0-1023), buttons is a bitmap, radios is a tuple of (active, standby)"""
+        buffer = self.buffer
+        spins = 0
+        while True:
+            values = STATE_STRUCT.unpack_from(buffer, 0)
+            sequence = values[2]
+            if not (sequence & 1) and (SEQUENCE_STRUCT.unpack_from(buffer, SEQUENCE_OFFSET)[0] == sequence):
+                break
+            spins += 1
+            if spins > 100:
+                time.sleep(0) # Let the writer finish
+        axes_end = 4 + NUMBER_OF_AXES
+        radios = values[axes_end + 1:]
+        return SharedState(
+            sequence, values[3], values[4:axes_end], values[axes_end],
+            tuple((radios[2 * i], radios[2 * i + 1]) for i in range(NUMBER_OF_RADIOS)))
+
+    def axis(self, axis_num):
+        """Returns the axis value as a float 0.0-1.0"""
+        return self.read().axes[axis_num] / float(AXIS_MAX)
+
+    def button(self, btn_num):
+        return bool(self.read().buttons & (1 << btn_num))
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.buffer.release()
+        self.shm.close()
+        self.shm = None
@@ -0,0 +1,73 @@
+#       OpenSimPit python SDK - board discovery tests
+#
+#       Run from the sdk/python directory:
+#           python -m unittest discover tests
+
+
+
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+import osp_discovery
+
+
+class FakePortInfo:
+    # Like a serial.tools.list_ports entry
+    def __init__(self, device, serial_number):
+        self.device = device
+        self.vid = 0x2341
+        self.pid = 0x0043
+        self.serial_number = serial_number
+        self.location = None
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.cache_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        os.remove(self.cache_path)
+        self.saved_probe = osp_discovery.probe_port
+        self.probed = []
+        self.answers = []
+        osp_discovery.probe_port = self.fake_probe
+        self.ports = [FakePortInfo('/dev/ttyACM0', 'ABC')]
+
+    def tearDown(self):
+        osp_discovery.probe_port = self.saved_probe
+        osp_discovery.forget(self.cache_path)
+
+    def fake_probe(self, port, timeout):
+        self.probed.append(port)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def discover(self):
+        return osp_discovery.discover(self.ports, cache_path=self.cache_path)
+
+    def test_failed_open_is_not_cached(self):
+        self.answers = [OSError("busy"), "Arduino Uno"]
+        self.assertEqual(self.discover(), [])
+        found = self.discover()
+        self.assertEqual([item.board for item in found], ["Arduino Uno"])
+        self.assertEqual(len(self.probed), 2)
+
+    def test_no_answer_is_cached_until_it_expires(self):
+        self.answers = [None, "Arduino Uno"]
+        self.assertEqual(self.discover(), [])
+        self.assertEqual(self.discover(), [])
+        self.assertEqual(len(self.probed), 1)
+
+        cache = osp_discovery.load_json_cache(self.cache_path)
+        cache["2341:0043:ABC"] -= osp_discovery.NEGATIVE_CACHE_TIME
+        osp_discovery.save_json_cache(self.cache_path, cache)
+        found = self.discover()
+        self.assertEqual([item.board for item in found], ["Arduino Uno"])
+        self.assertEqual(len(self.probed), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
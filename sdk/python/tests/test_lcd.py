@@ -0,0 +1,57 @@
+#       OpenSimPit python SDK - 16x2 LCD output tests
+#
+#       Run from the sdk/python directory:
+#           python -m unittest discover tests
+
+
+
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+
+
+class LCD16x2ResendTest(unittest.TestCase):
+
+    def setUp(self):
+        # Not connected to any board, the commands written are recorded and
+        # answered by the test
+        self.osp = opensimpit.OpenSimPit(None, auto_reconnect=False, ready_timeout=0)
+        self.written = []
+        self.osp.connection._write_commands = lambda data, futures: self.written.append(data)
+        self.osp.connection.writer.start()
+
+    def tearDown(self):
+        self.osp.connection.close()
+
+    def message(self, text, answer):
+        self.osp.lcd16x2_message(0, 0, 0, text)
+        self.osp.connection.flush(1)
+        self.osp.connection.writer.answer(answer)
+
+    def commands(self):
+        return b''.join(self.written).decode().splitlines()
+
+    def test_rejected_text_is_sent_again(self):
+        self.message("HELLO", False)
+        self.message("HELLO", True)
+        self.assertEqual(self.commands(), ['!LC=0,0,0,HELLO', '!LC=0,0,0,HELLO'])
+
+    def test_accepted_text_is_not_sent_again(self):
+        self.message("HELLO", True)
+        self.osp.lcd16x2_message(0, 0, 0, "HELLO")
+        self.osp.connection.flush(1)
+        self.assertEqual(self.commands(), ['!LC=0,0,0,HELLO'])
+
+    def test_failed_run_keeps_cells_changed_since(self):
+        self.osp.lcd16x2_message(0, 0, 0, "AB")
+        self.osp.lcd16x2_message(0, 0, 0, "XB") # Before "AB" is answered
+        self.osp.connection.flush(1)
+        self.osp.connection.writer.answer(False) # "AB"
+        self.osp.connection.writer.answer(True)  # "X"
+        self.osp.lcd16x2_message(0, 0, 0, "XB")
+        self.osp.connection.flush(1)
+        self.assertEqual(self.commands(), ['!LC=0,0,0,AB', '!LC=0,0,0,X', '!LC=0,0,1,B'])
+
+if __name__ == '__main__':
+    unittest.main()
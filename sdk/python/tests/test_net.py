@@ -0,0 +1,84 @@
+#       OpenSimPit python SDK - network fan-out tests
+#
+#       Run from the sdk/python directory:
+#           python -m unittest discover tests
+
+
+
+import os, sys, time, threading, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+import osp_net
+from osp_decode import PACKET_BUTTON
+
+
+class UdpSubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_timeout = osp_net.UDP_SUBSCRIPTION_TIMEOUT
+        osp_net.UDP_SUBSCRIPTION_TIMEOUT = 0.5
+        self.server = osp_net.EventServer(tcp_port=None, udp_port=0, host='127.0.0.1')
+        self.port = self.server.udp_socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        osp_net.UDP_SUBSCRIPTION_TIMEOUT = self.saved_timeout
+
+    def press(self, btn_num):
+        self.server.set_button(btn_num, True)
+        self.server.publish()
+
+    def test_idle_client_stays_subscribed(self):
+        client = osp_net.EventClient('127.0.0.1', self.port, udp=True)
+        received = []
+        def consume():
+            try:
+                for event in client.events():
+                    received.append(event)
+            except OSError:
+                pass # Closed by the test
+        thread = threading.Thread(target=consume, daemon=True)
+        thread.start()
+        time.sleep(0.1) # Subscribed
+        self.press(1)
+        time.sleep(1.5) # Idle for longer than the subscription timeout
+        self.press(2)
+        time.sleep(0.2)
+        client.close()
+        self.assertIn((PACKET_BUTTON, 1, True), received)
+        self.assertIn((PACKET_BUTTON, 2, True), received)
+
+
+class MulticastSnapshotTest(unittest.TestCase):
+
+    GROUP = '239.255.41.12'
+    PORT = 15431
+
+    def test_member_gets_each_packet_once(self):
+        server = osp_net.EventServer(tcp_port=None, udp_port=0, host='127.0.0.1', multicast_group=self.GROUP, multicast_port=self.PORT)
+        port = server.udp_socket.getsockname()[1]
+        try:
+            client = osp_net.EventClient('127.0.0.1', port, multicast_group=self.GROUP, multicast_port=self.PORT)
+        except OSError:
+            server.close()
+            self.skipTest("multicast is not available")
+        time.sleep(0.1)
+        server.set_button(4, True)
+        server.publish()
+        packets = []
+        # Shorter than MULTICAST_SNAPSHOT_INTERVAL, so no periodic snapshot
+        # repeats the event
+        deadline = time.monotonic() + 0.3
+        while time.monotonic() < deadline:
+            records = client.receive(0.05)
+            if records:
+                packets.append((client.sequence, records))
+        client.close()
+        server.close()
+        self.assertEqual(server._udp_clients, {})
+        self.assertEqual(packets, [(1, [(PACKET_BUTTON, 4, True)])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#       OpenSimPit python SDK - receive queue tests
+#
+#       Run from the sdk/python directory:
+#           python -m unittest discover tests
+
+
+
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+from osp_queue import ReceiveQueue, OVERFLOW_COALESCE
+from osp_decode import PACKET_AXIS, PACKET_BUTTON
+
+
+def drain(queue):
+    """Consumes the queue like OpenSimPit.check(): slots peeked first, then
+    the queued packets, then the slots taken. Returns the final axis values"""
+    axes = {}
+    peeked = queue.peek_axes()
+    if peeked:
+        axes.update(peeked)
+    packet = queue.get()
+    while packet is not None:
+        if packet[0] == PACKET_AXIS:
+            axes[packet[1]] = packet[2]
+        packet = queue.get()
+    taken = queue.take_axes()
+    if taken:
+        axes.update(taken)
+    return axes
+
+
+class ReceiveQueueTest(unittest.TestCase):
+
+    def test_slot_is_newest_after_backlog_shrinks(self):
+        queue = ReceiveQueue(8, coalesce_backlog=3)
+        for btn_num in range(3):
+            queue.put((PACKET_BUTTON, btn_num, 1))
+        queue.put((PACKET_AXIS, 3, 100)) # Backlog: goes to the slot
+        queue.get()
+        queue.get()
+        queue.put((PACKET_AXIS, 3, 900)) # Backlog is under 3, but the slot is in use
+        self.assertEqual(drain(queue), {3: 900})
+
+    def test_queued_value_older_than_slot_is_skipped(self):
+        queue = ReceiveQueue(8, coalesce_backlog=2)
+        queue.put((PACKET_AXIS, 1, 50))
+        queue.put((PACKET_BUTTON, 0, 1))
+        queue.put((PACKET_AXIS, 1, 600))
+        self.assertEqual(queue.peek_axes(), {1: 600})
+        self.assertEqual(queue.get(), (PACKET_BUTTON, 0, 1))
+        self.assertIsNone(queue.get())
+        self.assertIsNone(queue.take_axes()) # Already delivered by peek_axes()
+
+    def test_values_after_take_are_queued_in_order(self):
+        queue = ReceiveQueue(8, coalesce_backlog=2)
+        queue.put((PACKET_BUTTON, 0, 1))
+        queue.put((PACKET_BUTTON, 1, 1))
+        queue.put((PACKET_AXIS, 2, 10))
+        self.assertEqual(drain(queue), {2: 10})
+        queue.put((PACKET_AXIS, 2, 20))
+        self.assertEqual(queue.get(), (PACKET_AXIS, 2, 20))
+
+    def test_overflow_coalesce_keeps_newest(self):
+        queue = ReceiveQueue(2, OVERFLOW_COALESCE)
+        queue.put((PACKET_AXIS, 0, 1))
+        queue.put((PACKET_BUTTON, 0, 1))
+        queue.put((PACKET_AXIS, 0, 700)) # Full: to the slot
+        queue.get()
+        queue.put((PACKET_AXIS, 0, 800)) # Room again, the slot must still win
+        self.assertEqual(drain(queue), {0: 800})
+
+
+class CheckBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        # Not connected to any board, packets are put in the queue directly
+        self.osp = opensimpit.OpenSimPit(None, auto_reconnect=False, ready_timeout=0, coalesce_backlog=4)
+        self.axes = []
+        self.buttons = []
+        self.osp.add_function_for_axis(lambda num, value: self.axes.append((num, round(value * 1023))))
+        self.osp.add_function_for_button_state(lambda num, value: self.buttons.append(num))
+        self.queue = self.osp.connection.received_queue
+
+    def tearDown(self):
+        self.osp.connection.close()
+
+    def test_latest_axis_first_and_never_overridden(self):
+        for i in range(10):
+            self.queue.put((PACKET_AXIS, 0, i))
+            self.queue.put((PACKET_BUTTON, i, 1))
+        remaining = self.osp.check(max_events=3)
+        self.assertEqual(self.axes[0], (0, 9))
+        self.assertGreater(remaining, 0)
+        while self.osp.check(max_events=3):
+            pass
+        self.assertEqual(self.axes[-1], (0, 9))
+        self.assertEqual(self.buttons, list(range(10)))
+
+
+class CoalescedAxesCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.osp = opensimpit.OpenSimPit(None, auto_reconnect=False, ready_timeout=0, coalesce_axes=True)
+        self.axes = []
+        self.osp.add_function_for_axis(lambda num, value: self.axes.append((num, round(value * 1023))))
+        self.queue = self.osp.connection.received_queue
+
+    def tearDown(self):
+        self.osp.connection.close()
+
+    def test_axis_changed_during_check_waits_for_next_check(self):
+        # The reader thread updates the slot while the button is handled
+        self.osp.add_function_for_button_state(lambda num, value: self.queue.put((PACKET_AXIS, 0, 200)))
+        self.queue.put((PACKET_AXIS, 0, 100))
+        self.queue.put((PACKET_AXIS, 1, 50))
+        self.queue.put((PACKET_BUTTON, 0, 1))
+        self.osp.check()
+        self.assertEqual(sorted(self.axes), [(0, 100), (1, 50)])
+        self.osp.check()
+        self.assertEqual(sorted(self.axes), [(0, 100), (0, 200), (1, 50)])
+        self.assertEqual(self.osp.check(), 0)
+        self.assertEqual(len(self.axes), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#       OpenSimPit python SDK - servo output tests
+#
+#       Run from the sdk/python directory:
+#           python -m unittest discover tests
+
+
+
+import os, sys, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensimpit
+
+
+class ServoRateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        # Not connected to any board, the commands written are recorded
+        self.osp = opensimpit.OpenSimPit(None, auto_reconnect=False, ready_timeout=0)
+        self.written = []
+        self.osp.connection._write_commands = lambda data, futures: self.written.append(data)
+        self.osp.connection.writer.start()
+
+    def tearDown(self):
+        self.osp.connection.close()
+
+    def commands(self):
+        return b''.join(self.written).decode().split()
+
+    def test_held_back_target_is_sent_without_check(self):
+        self.osp.servo_set_position(0, 10)
+        time.sleep(0.01)
+        self.osp.servo_set_position(0, 90)
+        time.sleep(2.0 / opensimpit.osplib.DEFAULT_SERVO_MAX_RATE)
+        self.assertEqual(self.commands(), ['!S=0,10', '!S=0,90'])
+
+    def test_unchanged_target_is_not_sent(self):
+        self.osp.servo_set_position(3, 50)
+        self.osp.servo_set_position(3, 50)
+        time.sleep(2.0 / opensimpit.osplib.DEFAULT_SERVO_MAX_RATE)
+        self.assertEqual(self.commands(), ['!S=3,50'])
+
+    def test_rejected_target_is_not_dropped_as_unchanged(self):
+        self.osp.servo_set_max_rate(5, None)
+        self.osp.servo_set_position(5, 30)
+        self.osp.connection.flush(1)
+        self.osp.connection.writer.answer(False)
+        self.osp.servo_set_position(5, 30)
+        self.osp.connection.flush(1)
+        self.assertEqual(self.commands(), ['!S=5,30', '!S=5,30'])
+
+
+if __name__ == '__main__':
+    unittest.main()